@@ -0,0 +1,284 @@
+"""
+Asynchronous low-stock alert dispatch
+Uploads enqueue alerts (one digest per upload, or one per ingredient) and
+return immediately; a small pool of background threads drains the queue,
+retrying failed sends with exponential backoff
+
+With MongoDB the queue is durable: each alert is a document in the alerts
+collection whose status moves queued -> sending -> sent / printed_to_console
+/ failed. Workers in any gunicorn process claim alerts atomically, and alerts
+left in 'sending' by a crashed worker are reclaimed after a lease timeout.
+The app starts the workers at startup when MongoDB is enabled, so alerts
+queued before a restart are delivered without waiting for a new one.
+Without MongoDB (or while it is unreachable) an in-process queue is used
+instead; alerts already in MongoDB wait there until it is back.
+"""
+import random
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from email_service import PartialDeliveryError, send_low_stock_alert, send_low_stock_digest
+from log import correlation, get_correlation_id, get_logger
+from metrics import mongo_write
+
+logger = get_logger('alerts')
+
+# Statuses after which an alert is never picked up again
+FINAL_STATUSES = ('sent', 'printed_to_console', 'failed')
+
+class AlertQueue:
+    """
+    Durable alert queue with a background worker pool
+    
+    Args:
+        get_collection: Function returning the MongoDB alerts collection, or None
+            while MongoDB is unavailable (omit for an in-process queue only)
+        send: Transport function with send_low_stock_alert's signature
+        send_digest: Transport function with send_low_stock_digest's signature
+        workers: Number of background sender threads
+        max_attempts: Sends tried before an alert is marked failed
+        retry_base: Seconds before the first retry (doubles on every attempt)
+        poll_interval: Seconds between queue polls when idle
+        lease: Seconds before an alert stuck in 'sending' is retried
+    """
+    
+    def __init__(self, get_collection=None, send=send_low_stock_alert, send_digest=send_low_stock_digest,
+                 workers=2, max_attempts=5, retry_base=5, poll_interval=5, lease=120):
+        self.get_collection = get_collection or (lambda: None)
+        self.send = send
+        self.send_digest = send_digest
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.poll_interval = poll_interval
+        self.lease = lease
+        
+        self._local = OrderedDict()  # alert_id -> doc, used without MongoDB
+        self._local_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+    
+    def start(self):
+        """Start the worker threads (idempotent; restarts them in a forked child)"""
+        with self._start_lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'alert-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+    
+    def enqueue(self, email, ingredient, days_remaining, daily_usage, email_configured, recipients=None):
+        """
+        Queue a single-ingredient low-stock alert for background delivery
+        recipients are the addresses to send to (defaults to the account email)
+        
+        Returns:
+            Alert id (string) that can be used to poll its status
+        """
+        return self._enqueue({
+            'email': email,
+            'kind': 'single',
+            'recipients': list(recipients or [email]),
+            'ingredient': ingredient,
+            'days_remaining': days_remaining,
+            'daily_usage': daily_usage,
+            'email_configured': email_configured
+        })
+    
+    def enqueue_digest(self, email, items, email_configured, recipients=None):
+        """
+        Queue one digest email covering several low-stock ingredients
+        
+        Args:
+            email: Account email
+            items: List of dicts with ingredient, days_remaining, daily_usage
+            email_configured: Whether a real transport is configured
+            recipients: Addresses to send to (defaults to the account email)
+        
+        Returns:
+            Alert id (string) that can be used to poll its status
+        """
+        return self._enqueue({
+            'email': email,
+            'kind': 'digest',
+            'recipients': list(recipients or [email]),
+            'items': items,
+            'email_configured': email_configured
+        })
+    
+    def _enqueue(self, doc):
+        """Add queue bookkeeping to an alert document, store it and wake a worker"""
+        now = datetime.utcnow()
+        doc.update(status='queued', attempts=0, queued_at=now, next_attempt_at=now,
+                   correlation_id=get_correlation_id())
+        
+        collection = self.get_collection()
+        if collection is not None:
+            try:
+                with mongo_write('alert_enqueue'):
+                    collection.insert_one(doc)
+            except PyMongoError as e:
+                logger.warning(f"Could not queue alert in MongoDB ({e}) - queueing in process")
+                doc.pop('_id', None)
+                collection = None
+        
+        if collection is not None:
+            alert_id = str(doc['_id'])
+        else:
+            alert_id = uuid.uuid4().hex
+            doc['_id'] = alert_id
+            with self._local_lock:
+                self._local[alert_id] = doc
+                self._trim_local()
+        
+        self.start()
+        self._wakeup.set()
+        return alert_id
+    
+    def statuses(self, email, alert_ids=None, limit=50):
+        """
+        Delivery status of an account's alerts, newest first
+        
+        Args:
+            email: Account email
+            alert_ids: Only return these alerts (optional)
+            limit: Maximum number of alerts returned
+        """
+        fields = ('kind', 'ingredient', 'days_remaining', 'items', 'status', 'attempts',
+                  'transport', 'error', 'queued_at', 'sent_at')
+        
+        with self._local_lock:
+            docs = [doc for doc in reversed(self._local.values())
+                    if doc['email'] == email and (not alert_ids or doc['_id'] in alert_ids)]
+        
+        collection = self.get_collection()
+        if collection is not None:
+            query = {'email': email, 'status': {'$exists': True}}
+            if alert_ids:
+                object_ids = []
+                for alert_id in alert_ids:
+                    try:
+                        object_ids.append(ObjectId(alert_id))
+                    except (InvalidId, TypeError):
+                        continue
+                query['_id'] = {'$in': object_ids}
+            docs += list(collection.find(query, {field: 1 for field in fields},
+                                         sort=[('queued_at', -1)], limit=limit))
+            docs.sort(key=lambda doc: doc['queued_at'], reverse=True)
+        
+        results = []
+        for doc in docs[:limit]:
+            result = {'id': str(doc['_id'])}
+            for field in fields:
+                value = doc.get(field)
+                result[field] = value.isoformat() if isinstance(value, datetime) else value
+            results.append(result)
+        return results
+    
+    def _run(self):
+        """Worker loop: claim and deliver alerts until the process exits"""
+        while True:
+            try:
+                alert = self._claim()
+            except Exception as e:
+                logger.warning(f"Alert queue error: {e}")
+                alert = None
+            
+            if alert is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            
+            with correlation(alert.get('correlation_id')):
+                self._deliver(alert)
+    
+    def _claim(self):
+        """Atomically claim the next due alert (in-process ones first), or return None"""
+        now = datetime.utcnow()
+        
+        with self._local_lock:
+            for doc in self._local.values():
+                if doc['status'] == 'queued' and doc['next_attempt_at'] <= now:
+                    doc.update(status='sending', claimed_at=now, attempts=doc['attempts'] + 1)
+                    return dict(doc)
+        
+        collection = self.get_collection()
+        if collection is None:
+            return None
+        return collection.find_one_and_update(
+            {'$or': [
+                {'status': 'queued', 'next_attempt_at': {'$lte': now}},
+                {'status': 'sending', 'claimed_at': {'$lt': now - timedelta(seconds=self.lease)}}
+            ]},
+            {'$set': {'status': 'sending', 'claimed_at': now}, '$inc': {'attempts': 1}},
+            sort=[('next_attempt_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+    
+    def _deliver(self, alert):
+        """Send one alert and record the outcome"""
+        try:
+            if alert.get('kind') == 'digest':
+                transport = self.send_digest(to_emails=alert['recipients'], items=alert['items'])
+            else:
+                transport = self.send(
+                    to_email=alert.get('recipients') or alert['email'],
+                    ingredient=alert['ingredient'],
+                    days_remaining=alert['days_remaining'],
+                    daily_usage=alert['daily_usage']
+                )
+            update = {
+                'status': 'printed_to_console' if transport == 'console' else 'sent',
+                'transport': transport,
+                'sent_at': datetime.utcnow(),
+                'error': None
+            }
+        except Exception as e:
+            if alert['attempts'] >= self.max_attempts:
+                update = {'status': 'failed', 'error': str(e)}
+                logger.warning(f"Alert {alert['_id']} for {alert['email']} failed after {alert['attempts']} attempts: {e}")
+            else:
+                # Exponential backoff with a little jitter
+                delay = self.retry_base * 2 ** (alert['attempts'] - 1) * random.uniform(0.8, 1.2)
+                update = {
+                    'status': 'queued',
+                    'error': str(e),
+                    'next_attempt_at': datetime.utcnow() + timedelta(seconds=delay)
+                }
+            if isinstance(e, PartialDeliveryError):
+                # Only the recipients that missed it get the retry
+                update['recipients'] = e.undelivered
+        
+        with self._local_lock:
+            local = self._local.get(alert['_id'])
+            if local is not None:
+                local.update(update)
+                return
+        
+        # A MongoDB alert whose status can't be recorded is retried after the lease
+        try:
+            collection = self.get_collection()
+            if collection is None:
+                raise RuntimeError('MongoDB unavailable')
+            with mongo_write('alert_status'):
+                collection.update_one({'_id': alert['_id']}, {'$set': update})
+        except Exception as e:
+            logger.warning(f"Error recording alert status: {e}")
+    
+    def _trim_local(self, max_size=1000):
+        """Forget the oldest finished alerts so the in-process queue stays bounded"""
+        if len(self._local) <= max_size:
+            return
+        for alert_id in [alert_id for alert_id, doc in self._local.items() if doc['status'] in FINAL_STATUSES]:
+            del self._local[alert_id]
+            if len(self._local) <= max_size:
+                break
@@ -2,63 +2,120 @@
 StockWise MVP - MicroSaaS tool to prevent cafes from running out of ingredients
 """
 import os
+import math
+import re
+import time
+import multiprocessing
+import shutil
+import threading
+import uuid
+import zipfile
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, g
 from werkzeug.utils import secure_filename
-from pymongo import MongoClient
 from dotenv import load_dotenv
 
-# Import email service
-from email_service import send_low_stock_alert
+# Import background alert delivery
+from alert_queue import AlertQueue
+
+# Import background upload processing
+from jobs import JobRunner
+
+# Import CSV format detection and parsing
+from csv_ingest import (SCHEMA_ROLES, get_csv_format, forget_csv_format, with_encoding_fallback, detect_schema,
+                        check_date_format, parse_usage_file, file_digest, load_cached_sales, store_cached_sales,
+                        sales_digest, explode_usage, _no_progress)
+
+# Import structured (JSON / NDJSON) sales ingestion
+from json_ingest import NDJSON_TYPES, columnar_sales, stream_ndjson_sales
+
+# Import forecasting models
+from forecasting import MODELS, compute_forecast, get_model
+
+# Import lazy MongoDB access
+from database import MongoStore
+
+# Import daily usage history store
+from usage_store import merge_daily_usage, load_trailing_usage, load_usage_history
+
+# Import metrics instrumentation
+import metrics
+
+# Import logging setup
+from log import (call_with_correlation, get_correlation_id, get_logger, new_correlation_id,
+                 reset_correlation_id, set_correlation_id, setup_logging)
 
 # Import configuration
 from config import Config
 
+# Import in-process cache
+from cache import LRUCache
+
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 app.config.from_object(Config)
+
+setup_logging()
+logger = get_logger('app')
 # Add TEST_MODE to app config
 app.config['TEST_MODE'] = Config.TEST_MODE
 
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# MongoDB connection - make it non-blocking and optional
-db = None
-csv_collection = None
-mappings_collection = None
-alerts_collection = None
+# MongoDB - connected lazily on first use, so worker startup never waits on
+# the network; while it is unreachable the in-process fallbacks are used
+mongo = MongoStore(
+    app.config['MONGODB_URI'],
+    app.config['MONGODB_DB_NAME'],
+    max_pool_size=app.config['MONGODB_MAX_POOL_SIZE'],
+    min_pool_size=app.config['MONGODB_MIN_POOL_SIZE'],
+    max_idle_ms=app.config['MONGODB_MAX_IDLE_MS'],
+    connect_timeout_ms=app.config['MONGODB_CONNECT_TIMEOUT_MS'],
+    server_selection_timeout_ms=app.config['MONGODB_SERVER_SELECTION_TIMEOUT_MS'],
+    socket_timeout_ms=app.config['MONGODB_SOCKET_TIMEOUT_MS'],
+    heartbeat_ms=app.config['MONGODB_HEARTBEAT_MS']
+)
+if not mongo.enabled:
+    logger.warning("MongoDB URI not configured or using localhost - running without MongoDB. "
+                   "Data will not persist between restarts. Set MONGODB_URI environment variable for persistence.")
 
-mongodb_uri = app.config.get('MONGODB_URI', '').strip()
-# Only try to connect if MongoDB URI is provided and not localhost (for production)
-if mongodb_uri and mongodb_uri != 'mongodb://localhost:27017/' and 'localhost' not in mongodb_uri:
-    try:
-        # Set a shorter timeout to avoid hanging
-        mongo_client = MongoClient(
-            mongodb_uri,
-            serverSelectionTimeoutMS=5000,  # 5 second timeout
-            connectTimeoutMS=5000
-        )
-        # Test connection
-        mongo_client.server_info()
-        db = mongo_client[app.config['MONGODB_DB_NAME']]
-        csv_collection = db['csv_uploads']
-        mappings_collection = db['ingredient_mappings']
-        alerts_collection = db['alerts']
-        print("✓ Connected to MongoDB")
-    except Exception as e:
-        print(f"⚠ MongoDB connection error: {e}")
-        print("⚠ Continuing without MongoDB - using local storage fallback")
-        db = None
-        csv_collection = None
-        mappings_collection = None
-        alerts_collection = None
-else:
-    print("⚠ MongoDB URI not configured or using localhost - running without MongoDB")
-    print("⚠ Data will not persist between restarts. Set MONGODB_URI environment variable for persistence.")
+# Background alert delivery (durable when MongoDB is available)
+alert_queue = AlertQueue(
+    mongo.collection_getter('alerts'),
+    workers=app.config['ALERT_WORKERS'],
+    max_attempts=app.config['ALERT_MAX_ATTEMPTS'],
+    retry_base=app.config['ALERT_RETRY_BASE_SECONDS']
+)
+if mongo.enabled:
+    # Drain alerts left in MongoDB by earlier processes (backed off, or stuck in 'sending')
+    alert_queue.start()
+
+# Background upload processing (job progress shared via MongoDB when available)
+upload_jobs = JobRunner(mongo.collection_getter('jobs'), workers=app.config['UPLOAD_JOB_WORKERS'],
+                        lease=app.config['UPLOAD_JOB_LEASE_SECONDS'])
+
+# Account settings (forecast model, alert recipients) when MongoDB isn't configured
+_account_settings = {}
+
+# Loose address check for alert recipients (delivery is the real test)
+EMAIL_PATTERN = re.compile(r'^[^@\s,;]+@[^@\s,;]+\.[^@\s,;]+$')
+
+# Column schemas when MongoDB isn't configured: {email: {header signature: schema doc}}
+_column_schemas = {}
+
+# Latest upload result per email when MongoDB isn't configured
+_recent_uploads = LRUCache(maxsize=1000)
+_latest_forecasts = LRUCache(maxsize=1000)
+
+# Worker processes for batch uploads, see get_parse_pool()
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
 
 # Hardcoded ingredient mapping for MVP
 # Format: {menu_item: {ingredient: amount_in_oz}}
@@ -76,177 +133,168 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def get_ingredient_mapping(email):
-    """Get ingredient mapping from MongoDB, or return default"""
-    if db is not None and mappings_collection is not None:
-        try:
-            mapping_doc = mappings_collection.find_one(
+# Compiled mappings per email: {email: (version, mapping, mapping_table)}
+_mapping_cache = LRUCache(maxsize=Config.MAPPING_CACHE_SIZE, ttl=Config.MAPPING_CACHE_TTL)
+
+def get_compiled_mapping(email):
+    """
+    Get the ingredient mapping and its compiled lookup table for an email
+    
+    Served from an in-process LRU cache. Each hit is validated against the
+    mapping document's version counter (a tiny projected read), so a mapping
+    saved through another gunicorn worker is never served stale.
+    
+    Returns:
+        (mapping dict, mapping_table DataFrame from build_mapping_table)
+    """
+    mappings_collection = mongo.collection('ingredient_mappings')
+    if mappings_collection is None:
+        cached = _mapping_cache.get(None)
+        metrics.MAPPING_LOOKUPS.labels(result='miss' if cached is None else 'hit').inc()
+        if cached is None:
+            cached = (0, DEFAULT_INGREDIENT_MAPPING, build_mapping_table(DEFAULT_INGREDIENT_MAPPING))
+            _mapping_cache.set(None, cached)
+        return cached[1], cached[2]
+    
+    cached = _mapping_cache.get(email)
+    try:
+        if cached is not None:
+            version_doc = mappings_collection.find_one(
                 {'email': email},
+                {'_id': 0, 'version': 1},
                 sort=[('updated_at', -1)]
             )
-            if mapping_doc and 'mapping' in mapping_doc:
-                return mapping_doc['mapping']
-        except Exception as e:
-            print(f"⚠ Error reading mapping from MongoDB: {e}")
-    return DEFAULT_INGREDIENT_MAPPING
+            if (version_doc or {}).get('version', 0) == cached[0]:
+                metrics.MAPPING_LOOKUPS.labels(result='hit').inc()
+                return cached[1], cached[2]
+        metrics.MAPPING_LOOKUPS.labels(result='miss' if cached is None else 'stale').inc()
+        
+        mapping_doc = mappings_collection.find_one(
+            {'email': email},
+            {'_id': 0, 'mapping': 1, 'version': 1},
+            sort=[('updated_at', -1)]
+        )
+        if mapping_doc and 'mapping' in mapping_doc:
+            mapping = mapping_doc['mapping']
+            version = mapping_doc.get('version', 0)
+        else:
+            mapping = DEFAULT_INGREDIENT_MAPPING
+            version = (mapping_doc or {}).get('version', 0)
+    except Exception as e:
+        logger.warning(f"Error reading mapping from MongoDB: {e}")
+        return DEFAULT_INGREDIENT_MAPPING, build_mapping_table(DEFAULT_INGREDIENT_MAPPING)
+    
+    cached = (version, mapping, build_mapping_table(mapping))
+    _mapping_cache.set(email, cached)
+    return cached[1], cached[2]
+
+def get_ingredient_mapping(email):
+    """Get ingredient mapping from MongoDB, or return default"""
+    return get_compiled_mapping(email)[0]
 
 def store_ingredient_mapping(email, mapping=None):
     """Store ingredient mapping in MongoDB"""
     if mapping is None:
         mapping = DEFAULT_INGREDIENT_MAPPING
     
-    if db is not None and mappings_collection is not None:
+    mappings_collection = mongo.collection('ingredient_mappings')
+    if mappings_collection is not None:
         try:
-            # Check if mapping exists
-            existing = mappings_collection.find_one({'email': email})
-            
-            mapping_doc = {
-                'email': email,
-                'mapping': mapping,
-                'updated_at': datetime.utcnow()
-            }
-            
-            if existing:
-                # Update existing mapping
+            # Single upsert; bumping the version invalidates other workers' caches
+            now = datetime.utcnow()
+            with metrics.mongo_write('mapping_save'):
                 mappings_collection.update_one(
                     {'email': email},
-                    {'$set': mapping_doc}
+                    {
+                        '$set': {'email': email, 'mapping': mapping, 'updated_at': now},
+                        '$setOnInsert': {'created_at': now},
+                        '$inc': {'version': 1}
+                    },
+                    upsert=True
                 )
-            else:
-                # Create new mapping
-                mapping_doc['created_at'] = datetime.utcnow()
-                mappings_collection.insert_one(mapping_doc)
         except Exception as e:
-            print(f"⚠ Error saving mapping to MongoDB: {e}")
+            logger.warning(f"Error saving mapping to MongoDB: {e}")
     
+    _mapping_cache.invalidate(email)
     return mapping
 
-def detect_csv_format(file_path):
+def build_mapping_table(mapping):
     """
-    Intelligently detect CSV format and read it appropriately
-    Handles various encodings, delimiters, and malformed formats
-    Optimized for Square POS exports
+    Flatten an ingredient mapping into a long table for vectorized joins
+    Returns a DataFrame with columns item_key (lowercased), ingredient, amount
     """
-    import csv
-    from io import StringIO
-    
-    # Square POS common formats:
-    # 1. Standard CSV with headers
-    # 2. TSV (tab-separated)
-    # 3. Excel-exported CSV (may have BOM)
-    # 4. Quoted rows format
+    # Case-insensitive lookup - later keys win, same as the old dict lookup
+    mapping_lookup = {}
+    for key, value in mapping.items():
+        mapping_lookup[key.lower().strip()] = value
     
-    # Try different encodings (Square POS often uses UTF-8 with BOM)
-    encodings = ['utf-8-sig', 'utf-8', 'latin-1', 'iso-8859-1', 'cp1252']
-    
-    for encoding in encodings:
-        try:
-            with open(file_path, 'r', encoding=encoding) as f:
-                # Read first few lines to detect format
-                first_lines = [f.readline() for _ in range(5)]
-                f.seek(0)
-                
-                # Check if it's Square POS format (common headers)
-                sample_text = ''.join(first_lines[:3])
-                is_square_pos = any(keyword in sample_text.lower() for keyword in 
-                                  ['item name', 'item_name', 'product name', 'sku', 
-                                   'quantity sold', 'net sales', 'gross sales'])
-                
-                # Detect delimiter - Square POS usually uses comma or tab
-                sample = f.read(2048)  # Read more for better detection
-                f.seek(0)
-                
-                # Try comma first (most common for Square)
-                if ',' in sample:
-                    delimiter = ','
-                elif '\t' in sample:
-                    delimiter = '\t'
-                else:
-                    # Use sniffer as fallback
-                    try:
-                        sniffer = csv.Sniffer()
-                        delimiter = sniffer.sniff(sample).delimiter
-                    except:
-                        delimiter = ','
-                
-                # Try reading with pandas - Square POS specific handling
-                try:
-                    # Square POS exports often have headers in first row
-                    df = pd.read_csv(f, encoding=encoding, delimiter=delimiter, 
-                                    quotechar='"', skipinitialspace=True, 
-                                    on_bad_lines='skip', engine='python',
-                                    skip_blank_lines=True)
-                except (TypeError, ValueError):
-                    # Fallback for older pandas versions
-                    f.seek(0)
-                    df = pd.read_csv(f, encoding=encoding, delimiter=delimiter, 
-                                    quotechar='"', skipinitialspace=True, 
-                                    engine='python')
-                
-                # Clean up Square POS specific issues
-                if not df.empty:
-                    # Remove completely empty rows
-                    df = df.dropna(how='all')
-                    # Remove rows where all values are the same (often headers repeated)
-                    if len(df) > 1:
-                        df = df[df.astype(str).nunique(axis=1) > 1]
-                
-                if len(df.columns) > 1 and not df.empty:
-                    print(f"✓ Detected CSV format: {encoding} encoding, {delimiter} delimiter")
-                    if is_square_pos:
-                        print("✓ Detected Square POS format")
-                    return df
-                    
-        except Exception as e:
-            continue
-    
-    # If standard reading fails, try manual parsing
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        # Check if entire rows are quoted
-        if lines and lines[0].strip().startswith('"') and ',' in lines[0]:
-            cleaned_lines = []
-            for line in lines:
-                line = line.strip()
-                if line.startswith('"') and line.endswith('"'):
-                    line = line[1:-1]
-                cleaned_lines.append(line)
-            
-            csv_string = '\n'.join(cleaned_lines)
-            df = pd.read_csv(StringIO(csv_string))
-            return df
-    except:
-        pass
-    
-    # Last resort: try reading with default settings
-    return pd.read_csv(file_path, on_bad_lines='skip', engine='python')
+    rows = [
+        (item_key, ingredient, float(amount))
+        for item_key, ingredients in mapping_lookup.items()
+        for ingredient, amount in ingredients.items()
+    ]
+    return pd.DataFrame(rows, columns=['item_key', 'ingredient', 'amount'])
+
+def get_parse_pool():
+    """Worker processes for parsing batch uploads, started on first use"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=app.config['PARSE_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn')  # never fork a threaded server
+            )
+        return _parse_pool
 
-def find_column_by_keywords(df, keywords_list, priority_order=None):
+def parse_files(file_paths, mapping_table, fingerprints, cache_keys, progress=_no_progress):
     """
-    Find column by matching keywords (case-insensitive, partial match)
-    Returns best match based on priority
+    Aggregate several files into one daily usage frame
+    Each file is parsed in its own worker process and the per-day ingredient
+    totals are summed at the end (e.g. one export per location)
+    
+    Returns:
+        (usage_df with date/ingredient/usage_oz, set of item names seen, rows parsed,
+         encodings the files were read in)
     """
-    df_cols_lower = [col.lower() for col in df.columns]
+    options = dict(streaming=app.config['STREAMING_INGEST'], chunk_size=app.config['CSV_CHUNK_SIZE'])
     
-    # If priority order specified, use it
-    if priority_order:
-        for priority_keyword in priority_order:
-            for i, col_lower in enumerate(df_cols_lower):
-                if priority_keyword.lower() in col_lower:
-                    return df.columns[i]
+    # A single file gains nothing from a worker process - parse it here with live progress
+    if len(file_paths) == 1:
+        usage_df, all_items, rows_parsed, fingerprint = parse_usage_file(
+            file_paths[0], mapping_table, fingerprints[0], progress=progress, cache_key=cache_keys[0], **options
+        )
+        return usage_df, all_items, rows_parsed, {fingerprint['encoding']}
     
-    # Otherwise, find first match
-    for keywords in keywords_list:
-        for keyword in keywords:
-            for i, col_lower in enumerate(df_cols_lower):
-                if keyword.lower() in col_lower:
-                    return df.columns[i]
+    global _parse_pool
+    pool = get_parse_pool()
+    try:
+        # Workers log under this upload's correlation id
+        futures = [pool.submit(call_with_correlation, get_correlation_id(), parse_usage_file,
+                               file_path, mapping_table, fingerprint, cache_key=cache_key, **options)
+                   for file_path, fingerprint, cache_key in zip(file_paths, fingerprints, cache_keys)]
+        
+        usage_dfs, all_items, rows_parsed, encodings = [], set(), 0, set()
+        for files_parsed, future in enumerate(as_completed(futures), start=1):
+            usage_df, items, rows, fingerprint = future.result()
+            usage_dfs.append(usage_df)
+            encodings.add(fingerprint['encoding'])
+            all_items.update(items)
+            rows_parsed += rows
+            progress('parsing', files_parsed=files_parsed, files_total=len(file_paths), rows_parsed=rows_parsed)
+    except BrokenProcessPool:
+        # A worker died - start a fresh pool next time
+        with _parse_pool_lock:
+            _parse_pool = None
+        raise
     
-    return None
+    usage_df = pd.concat(usage_dfs, ignore_index=True)
+    if usage_df.empty:
+        return usage_df, all_items, rows_parsed, encodings
+    usage_df['date'] = pd.to_datetime(usage_df['date'])
+    usage_df = usage_df.groupby(['date', 'ingredient'], sort=False)['usage_oz'].sum().reset_index()
+    return usage_df, all_items, rows_parsed, encodings
 
-def process_csv(file_path, email, stock_levels=None):
+def process_csv(file_path, email, stock_levels=None, progress=None):
     """
     Process CSV file and calculate ingredient usage
     Adapts to various CSV formats automatically
@@ -255,151 +303,65 @@ def process_csv(file_path, email, stock_levels=None):
         file_path: Path to CSV file
         email: User email address
         stock_levels: Dict of {ingredient: stock_amount_in_oz}, defaults to 1000oz per ingredient
+        progress: Optional callback(stage, **counters) for job progress reporting
+    """
+    return process_csv_batch([file_path], email, stock_levels, progress)
+
+def process_csv_batch(file_paths, email, stock_levels=None, progress=None):
+    """
+    Process one or more CSV files (e.g. one per location) as a single upload
+    Usage from all files is summed per day before forecasting
+    
+    Args:
+        file_paths: List of paths to CSV files
+        email: User email address
+        stock_levels: Dict of {ingredient: stock_amount_in_oz}, defaults to 1000oz per ingredient
+        progress: Optional callback(stage, **counters) for job progress reporting
     """
     # Default stock levels if not provided
     if stock_levels is None:
         stock_levels = {}
+    progress = progress or _no_progress
     try:
-        # Intelligently detect and read CSV
-        df = detect_csv_format(file_path)
-        
-        if df.empty:
-            raise ValueError("CSV file is empty or could not be parsed")
-        
-        # Normalize column names
-        df.columns = df.columns.str.strip().str.strip('"').str.strip("'").str.lower()
-        
-        # Intelligently find columns using multiple strategies
-        # Date column - try various date-related keywords
-        date_col = find_column_by_keywords(
-            df, 
-            [['date', 'time', 'timestamp', 'created', 'sold', 'order'], 
-             ['day', 'when', 'dt']],
-            priority_order=['date', 'time', 'timestamp']
-        )
-        
-        # Item column - try product/item related keywords
-        item_col = find_column_by_keywords(
-            df,
-            [['item', 'product', 'name', 'menu', 'sku'],
-             ['description', 'title', 'product_name', 'item_name']],
-            priority_order=['item', 'product', 'name']
-        )
-        
-        # Quantity column
-        qty_col = find_column_by_keywords(
-            df,
-            [['quantity', 'qty', 'amount', 'count', 'units'],
-             ['qty', 'num', 'number']],
-            priority_order=['quantity', 'qty', 'amount']
-        )
-        
-        # If still not found, try using first few columns as fallback
-        if not date_col and len(df.columns) > 0:
-            # Check if first column looks like dates
-            first_col = df.columns[0]
-            sample_values = df[first_col].head(5).astype(str)
-            if any(pd.to_datetime(sample_values, errors='coerce').notna().any()):
-                date_col = first_col
-        
-        if not item_col and len(df.columns) > 1:
-            # Use second column as item if date was first
-            if date_col == df.columns[0] and len(df.columns) > 1:
-                item_col = df.columns[1]
-            else:
-                item_col = df.columns[0] if df.columns[0] != date_col else (df.columns[1] if len(df.columns) > 1 else None)
+        progress('detecting')
         
-        if not date_col or not item_col:
-            available_cols = ', '.join(df.columns.tolist())
-            raise ValueError(
-                f"Could not automatically detect required columns.\n"
-                f"Found columns: {available_cols}\n"
-                f"Please ensure your CSV has date/time and item/product columns."
-            )
+        # Get ingredient mapping (from MongoDB or default) and its compiled
+        # long (item_key, ingredient, amount) table
+        mapping, mapping_table = get_compiled_mapping(email)
         
-        print(f"✓ Detected columns - Date: {date_col}, Item: {item_col}, Quantity: {qty_col if qty_col else 'N/A (using 1 per row)'}")
+        # Detect each file's format from a small sample (or reuse this uploader's
+        # cached one), and its columns from the account's schema for that header
+        with metrics.stage('detect'):
+            schemas = {}
+            fingerprints = [resolve_schema(email, file_path, get_csv_format(file_path, email), schemas)
+                            for file_path in file_paths]
         
-        # Clean data - strip quotes from all string columns
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.strip().str.strip('"').str.strip("'")
-        
-        # Parse dates
-        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-        df = df.dropna(subset=[date_col])
-        
-        # Use quantity column if available, otherwise assume 1 per row
-        if qty_col:
-            df['quantity'] = pd.to_numeric(df[qty_col], errors='coerce').fillna(1)
+        # Files uploaded before are read back from the parsed cache by content hash
+        if app.config['PARSED_CACHE']:
+            with metrics.stage('hash'):
+                cache_keys = [file_digest(file_path, dict(fingerprint.get('columns') or {},
+                                                          date_format=fingerprint.get('date_format')))
+                              for file_path, fingerprint in zip(file_paths, fingerprints)]
         else:
-            df['quantity'] = 1
-        
-        # Get ingredient mapping (from MongoDB or default)
-        mapping = get_ingredient_mapping(email)
-        
-        # Create a case-insensitive lookup dictionary
-        mapping_lookup = {}
-        for key, value in mapping.items():
-            mapping_lookup[key.lower().strip()] = value
-        
-        # Calculate daily ingredient usage (optimized for memory)
-        daily_usage = {}
-        found_items = set()
-        all_items = set()
+            cache_keys = [None] * len(file_paths)
         
-        # Process in chunks to reduce memory usage
-        chunk_size = 1000
-        for chunk_start in range(0, len(df), chunk_size):
-            chunk_end = min(chunk_start + chunk_size, len(df))
-            chunk_df = df.iloc[chunk_start:chunk_end]
-            
-            for _, row in chunk_df.iterrows():
-                try:
-                    item_name = str(row[item_col]).strip()
-                    item_name_lower = item_name.lower().strip()
-                    all_items.add(item_name)
-                    
-                    # Get quantity (already cleaned and converted)
-                    quantity = float(row['quantity'])
-                    
-                    # Get date (already parsed)
-                    date = row[date_col].date()
-                    
-                    # Find matching ingredient mapping (case-insensitive)
-                    if item_name_lower in mapping_lookup:
-                        found_items.add(item_name)
-                        ingredients = mapping_lookup[item_name_lower]
-                        for ingredient, amount_per_unit in ingredients.items():
-                            if ingredient not in daily_usage:
-                                daily_usage[ingredient] = {}
-                            if date not in daily_usage[ingredient]:
-                                daily_usage[ingredient][date] = 0
-                            daily_usage[ingredient][date] += amount_per_unit * quantity
-                except Exception as e:
-                    print(f"⚠ Error processing row: {e}")
-                    continue
-            
-            # Free memory after each chunk
-            del chunk_df
+        # Stream files in chunks when possible, otherwise read them whole
+        parse_start = time.perf_counter()
+        with metrics.stage('parse'):
+            usage_df, all_items, rows_parsed, encodings = parse_files(file_paths, mapping_table, fingerprints,
+                                                                      cache_keys, progress)
+        metrics.observe_parse(rows_parsed, time.perf_counter() - parse_start)
         
-        # Convert to DataFrame for easier processing
-        usage_data = []
-        for ingredient, dates in daily_usage.items():
-            for date, amount in dates.items():
-                usage_data.append({
-                    'date': date,
-                    'ingredient': ingredient,
-                    'usage_oz': amount
-                })
-        
-        usage_df = pd.DataFrame(usage_data)
+        # A file that had to be re-read in another encoding means the cached
+        # fingerprint can't be trusted for this uploader's next export
+        if encodings - {fingerprint['encoding'] for fingerprint in fingerprints}:
+            forget_csv_format(email)
         
         if usage_df.empty:
             # Provide helpful error message
             found_items_str = ', '.join(sorted(all_items)) if all_items else 'none'
             mapped_items = ', '.join(sorted(set([k.title() for k in mapping.keys() if k[0].isupper()])))
-            print(f"Debug: Items found in CSV: {found_items_str}")
-            print(f"Debug: Mapped items: {mapped_items}")
+            logger.debug(f"Items found in CSV: {found_items_str}; mapped items: {mapped_items}")
             raise ValueError(
                 f"No matching menu items found in CSV.\n\n"
                 f"Items found in CSV: {found_items_str}\n"
@@ -407,57 +369,419 @@ def process_csv(file_path, email, stock_levels=None):
                 f"Please ensure your CSV contains items like: Latte, Cappuccino, or Mocha"
             )
         
-        # Calculate 7-day rolling average
         usage_df = usage_df.sort_values('date')
         usage_df['date'] = pd.to_datetime(usage_df['date'])
+        forecast_results, result_doc = forecast_usage(email, usage_df, stock_levels, progress)
         
-        # Group by ingredient and calculate rolling average
-        forecast_results = {}
-        
-        for ingredient in usage_df['ingredient'].unique():
-            ing_df = usage_df[usage_df['ingredient'] == ingredient].copy()
-            ing_df = ing_df.set_index('date')
-            ing_df = ing_df.resample('D').sum().fillna(0)
-            
-            # Calculate 7-day rolling average
-            rolling_avg = ing_df['usage_oz'].rolling(window=7, min_periods=1).mean().iloc[-1]
-            
-            # Get stock level from user input or use default
-            current_stock_oz = stock_levels.get(ingredient, 1000)  # Default 1000oz if not specified
-            days_remaining = current_stock_oz / rolling_avg if rolling_avg > 0 else float('inf')
-            
-            forecast_results[ingredient] = {
-                'daily_avg_usage_oz': round(rolling_avg, 2),
-                'days_remaining': round(days_remaining, 2),
-                'current_stock_oz': current_stock_oz
-            }
-        
-        # Store results in MongoDB
-        if db is not None and csv_collection is not None:
-            try:
-                result_doc = {
-                    'email': email,
-                    'file_path': file_path,
-                    'processed_at': datetime.utcnow(),
-                    'forecast': forecast_results,
-                    'usage_data': usage_df.to_dict('records')
-                }
-                csv_collection.insert_one(result_doc)
-            except Exception as e:
-                print(f"⚠ Error saving to MongoDB: {e}")
+        result_doc['file_path'] = file_paths[0]
+        if len(file_paths) > 1:
+            result_doc['file_paths'] = file_paths
+        if any(cache_keys):
+            result_doc['content_hashes'] = cache_keys  # parsed cache entries, for re-forecasts
+        save_upload_result(result_doc)
         
         return forecast_results, usage_df
         
     except Exception as e:
         raise Exception(f"Error processing CSV: {str(e)}")
 
+def forecast_usage(email, usage_df, stock_levels, progress=_no_progress):
+    """
+    Merge new daily usage into the account's history and forecast every
+    ingredient it touches - the part of processing shared by CSV uploads and
+    /api/sales
+    
+    Returns:
+        (forecast results, result_doc to complete and pass to save_upload_result)
+    """
+    # Merge into the account's daily usage history, then forecast from each
+    # touched ingredient's trailing window only
+    model = get_model(get_forecast_model(email), app.config['FORECAST_WINDOW_DAYS'])
+    progress('forecasting', ingredients_total=int(usage_df['ingredient'].nunique()))
+    try:
+        with metrics.stage('history'):
+            db = mongo.get_db()
+            merge_daily_usage(db, email, usage_df)
+            history_df = load_trailing_usage(db, email, usage_df['ingredient'].unique(), model.history_days)
+            history_df = history_df.sort_values('date')
+    except Exception as e:
+        logger.warning(f"Error updating usage history: {e}")
+        history_df = usage_df
+    
+    # Forecast with the account's model (7-day rolling average by default)
+    with metrics.stage('forecast'):
+        forecast_results = compute_forecast(history_df, stock_levels, model=model)
+    progress('saving', ingredients_forecast=len(forecast_results))
+    
+    # Daily usage lives in the usage_buckets history - only keep its range here
+    result_doc = {
+        'email': email,
+        'processed_at': datetime.utcnow(),
+        'forecast': forecast_results,
+        'forecast_model': model.name,
+        'usage_start': usage_df['date'].min().to_pydatetime(),
+        'usage_end': usage_df['date'].max().to_pydatetime()
+    }
+    return forecast_results, result_doc
+
+def process_sales(email, sales, stock_levels=None):
+    """
+    Forecast from daily sales pushed through /api/sales
+    
+    Args:
+        email: User email address
+        sales: DataFrame with date, item, quantity columns (one row per day and item)
+        stock_levels: Dict of {ingredient: stock_amount_in_oz}; ingredients not
+            given keep the stock of the latest forecast
+    
+    Returns:
+        Forecast results dict, as from process_csv
+    Raises ValueError if no item matches the account's mapping
+    """
+    mapping, mapping_table = get_compiled_mapping(email)
+    usage_df = explode_usage(sales, mapping_table).reset_index() if not sales.empty else pd.DataFrame()
+    if usage_df.empty:
+        found_items = ', '.join(sorted(sales['item'].unique())) if not sales.empty else 'none'
+        raise ValueError(f"No matching menu items found in the sales data. Items found: {found_items}")
+    
+    try:
+        latest = latest_forecast(email)
+    except Exception as e:
+        logger.warning(f"Error reading latest stock levels: {e}")
+        latest = None
+    stock = dict((latest or {}).get('stock_levels') or {})
+    stock.update(stock_levels or {})
+    
+    forecast_results, result_doc = forecast_usage(email, usage_df.sort_values('date'), stock)
+    
+    # Keep the daily sales in the parsed cache, so a new mapping can be re-applied later
+    if app.config['PARSED_CACHE']:
+        cache_key = sales_digest(sales)
+        store_cached_sales(cache_key, sales)
+        result_doc['content_hashes'] = [cache_key]
+    result_doc['source'] = 'api'
+    save_upload_result(result_doc)
+    return forecast_results
+
+def get_account_setting(email, field):
+    """One field of an account's settings, or None if not set"""
+    settings = None
+    settings_collection = mongo.collection('account_settings')
+    if settings_collection is not None:
+        try:
+            settings = settings_collection.find_one({'email': email}, {field: 1})
+        except Exception as e:
+            logger.warning(f"Error reading account settings: {e}")
+    else:
+        settings = _account_settings.get(email)
+    return (settings or {}).get(field)
+
+def set_account_setting(email, field, value):
+    """Store one field of an account's settings"""
+    settings_collection = mongo.collection('account_settings')
+    if settings_collection is not None:
+        settings_collection.update_one(
+            {'email': email},
+            {'$set': {field: value, 'updated_at': datetime.utcnow()}},
+            upsert=True
+        )
+    else:
+        _account_settings.setdefault(email, {})[field] = value
+
+def get_forecast_model(email):
+    """Forecast model chosen by an account (Config.FORECAST_MODEL if none)"""
+    model = get_account_setting(email, 'forecast_model')
+    return model if model in MODELS else app.config['FORECAST_MODEL']
+
+def set_forecast_model(email, model):
+    """Choose the forecast model for an account"""
+    get_model(model)  # raises ValueError for unknown models
+    set_account_setting(email, 'forecast_model', model)
+
+def get_alert_recipients(email):
+    """Addresses an account's alerts go to (the account email if none are set)"""
+    return get_account_setting(email, 'alert_recipients') or [email]
+
+def set_alert_recipients(email, recipients):
+    """
+    Choose the addresses an account's alerts go to
+    An empty list goes back to the account email
+    
+    Returns:
+        The recipients now in effect
+    Raises ValueError for anything that isn't a list of email addresses
+    """
+    if not isinstance(recipients, list) or not all(isinstance(address, str) for address in recipients):
+        raise ValueError("recipients must be a list of email addresses")
+    recipients = list(dict.fromkeys(address.strip() for address in recipients if address.strip()))
+    invalid = [address for address in recipients if not EMAIL_PATTERN.match(address)]
+    if invalid:
+        raise ValueError(f"Invalid email address: {', '.join(invalid)}")
+    if len(recipients) > app.config['MAX_ALERT_RECIPIENTS']:
+        raise ValueError(f"At most {app.config['MAX_ALERT_RECIPIENTS']} recipients per account")
+    set_account_setting(email, 'alert_recipients', recipients)
+    return recipients or [email]
+
+def load_column_schema(email, signature):
+    """The account's column schema for a header signature, or None"""
+    schemas_collection = mongo.collection('column_schemas')
+    if schemas_collection is None:
+        return _column_schemas.get(email, {}).get(signature)
+    try:
+        return schemas_collection.find_one({'email': email, 'signature': signature},
+                                           {'_id': 0, 'signature': 1, 'header': 1, 'columns': 1, 'date_format': 1,
+                                            'source': 1, 'sample': 1})
+    except Exception as e:
+        logger.warning(f"Error reading column schema: {e}")
+        return None
+
+def save_column_schema(email, signature, header, columns, date_format=None, source='detected', sample=None):
+    """
+    Store the columns (and date format) to read for one header layout of an account
+    A detected schema never replaces an existing one (e.g. an override saved
+    meanwhile); an override always does. sample holds the first values of
+    each column (see column_sample), used to check date format overrides
+    """
+    doc = {'email': email, 'signature': signature, 'header': header, 'columns': columns,
+           'date_format': date_format, 'source': source, 'sample': sample, 'updated_at': datetime.utcnow()}
+    schemas_collection = mongo.collection('column_schemas')
+    if schemas_collection is not None:
+        update = {'$setOnInsert': doc} if source == 'detected' else {'$set': doc}
+        with metrics.mongo_write('column_schema'):
+            schemas_collection.update_one({'email': email, 'signature': signature}, update, upsert=True)
+    else:
+        account_schemas = _column_schemas.setdefault(email, {})
+        if source != 'detected' or signature not in account_schemas:
+            account_schemas[signature] = doc
+    return doc
+
+def set_schema_date_format(email, signature, date_format, sample=None):
+    """Record the date format (and column sample) of a stored schema that has none yet"""
+    schemas_collection = mongo.collection('column_schemas')
+    if schemas_collection is not None:
+        with metrics.mongo_write('column_schema'):
+            schemas_collection.update_one({'email': email, 'signature': signature, 'date_format': {'$exists': False}},
+                                          {'$set': {'date_format': date_format, 'sample': sample}})
+    else:
+        schema = _column_schemas.get(email, {}).get(signature, {})
+        if 'date_format' not in schema:
+            schema.update(date_format=date_format, sample=sample)
+
+def list_column_schemas(email):
+    """The account's column schemas, most recently updated first"""
+    fields = ('signature', 'header', 'columns', 'date_format', 'source', 'updated_at')
+    schemas_collection = mongo.collection('column_schemas')
+    if schemas_collection is None:
+        docs = list(_column_schemas.get(email, {}).values())
+    else:
+        docs = list(schemas_collection.find({'email': email}, {'_id': 0, **{field: 1 for field in fields}}))
+    docs.sort(key=lambda doc: doc['updated_at'], reverse=True)
+    return [{field: doc.get(field) for field in fields} for doc in docs]
+
+def resolve_schema(email, file_path, fingerprint, schemas=None):
+    """
+    Attach the columns and date format to read to a format fingerprint (as
+    fingerprint['columns'] and fingerprint['date_format'])
+    Both are resolved once per (email, header signature) and stored, so
+    repeat uploads of an export layout skip detection and format inference
+    and always read the same columns - including ones chosen through /api/schema
+    
+    Args:
+        schemas: Dict of {signature: schema} shared by the files of one upload
+    """
+    signature = fingerprint['signature']
+    schemas = {} if schemas is None else schemas
+    if signature not in schemas:
+        schema = load_column_schema(email, signature)
+        if schema is None or 'date_format' not in schema:
+            try:
+                (header, columns, date_format, sample), detected = with_encoding_fallback(
+                    lambda fingerprint: detect_schema(file_path, fingerprint, (schema or {}).get('columns')),
+                    file_path, fingerprint
+                )
+            except pd.errors.ParserError:
+                return fingerprint  # the full-file fallback reader resolves the columns itself
+            if detected['encoding'] != fingerprint['encoding']:
+                forget_csv_format(email)
+                fingerprint = detected
+            try:
+                if schema is None:
+                    schema = save_column_schema(email, signature, header, columns, date_format, sample=sample)
+                else:
+                    # Stored before date formats were remembered
+                    schema.update(date_format=date_format, sample=sample)
+                    set_schema_date_format(email, signature, date_format, sample)
+            except Exception as e:
+                logger.warning(f"Error saving column schema: {e}")
+                schema = schema or {'columns': columns, 'date_format': date_format}
+        schemas[signature] = schema
+    return dict(fingerprint, columns=schemas[signature]['columns'],
+                date_format=schemas[signature].get('date_format'))
+
+def forecast_snapshot(result_doc, etag=None):
+    """
+    The forecast_latest document for an upload result: just what /api/forecast
+    returns, keyed by email, with an ETag that changes on every run
+    """
+    forecast = result_doc['forecast']
+    return {
+        '_id': result_doc['email'],
+        'forecast': forecast,
+        'stock_levels': {ingredient: values.get('current_stock_oz') for ingredient, values in forecast.items()},
+        'forecast_model': result_doc.get('forecast_model'),
+        'computed_at': result_doc['processed_at'],
+        'etag': etag or uuid.uuid4().hex
+    }
+
+def save_upload_result(result_doc):
+    """
+    Record a processed upload (or re-forecast) as the account's latest result,
+    and replace the account's forecast_latest document
+    """
+    snapshot = forecast_snapshot(result_doc)
+    db = mongo.get_db()
+    if db is not None:
+        try:
+            with metrics.mongo_write('upload_result'):
+                db['csv_uploads'].insert_one(result_doc)
+        except Exception as e:
+            logger.warning(f"Error saving to MongoDB: {e}")
+        try:
+            with metrics.mongo_write('forecast_latest'):
+                db['forecast_latest'].replace_one({'_id': snapshot['_id']}, snapshot, upsert=True)
+        except Exception as e:
+            logger.warning(f"Error saving latest forecast to MongoDB: {e}")
+    else:
+        _recent_uploads.set(result_doc['email'], result_doc)
+        _latest_forecasts.set(result_doc['email'], snapshot)
+
+def latest_forecast(email):
+    """
+    The account's forecast_latest document (a single point lookup), or None
+    Accounts last processed before forecast_latest existed fall back to
+    their newest upload result
+    """
+    forecasts_collection = mongo.collection('forecast_latest')
+    if forecasts_collection is None:
+        return _latest_forecasts.get(email)
+    
+    snapshot = forecasts_collection.find_one({'_id': email})
+    if snapshot is None:
+        upload = latest_upload(email, fields=('email', 'forecast', 'forecast_model', 'processed_at'))
+        if upload is not None:
+            # Stable ETag so dashboards can still revalidate until the next run
+            snapshot = forecast_snapshot(upload, etag=str(upload['_id']))
+    return snapshot
+
+def latest_upload(email, fields=None):
+    """
+    The account's most recent upload (or re-forecast) result, or None
+    
+    Args:
+        email: User email address
+        fields: Only read these fields from MongoDB (default: the whole document)
+    """
+    csv_collection = mongo.collection('csv_uploads')
+    if csv_collection is not None:
+        projection = {field: 1 for field in fields} if fields else None
+        return csv_collection.find_one({'email': email}, projection, sort=[('processed_at', -1)])
+    return _recent_uploads.get(email)
+
+def reforecast(email, stock_levels=None, mapping=None, forecast_model=None):
+    """
+    Recompute the latest forecast without re-reading any CSV
+    New stock levels reuse the stored daily usage as is; a new mapping is
+    applied to the latest upload's cached (date, item, quantity) data and
+    merged into the usage history first
+    
+    Args:
+        email: User email address
+        stock_levels: Dict of {ingredient: stock_amount_in_oz}; ingredients not
+            given keep the stock of the latest forecast
+        mapping: New ingredient mapping to store and apply (optional)
+        forecast_model: Forecast model to switch the account to (optional)
+    
+    Returns:
+        Forecast results dict, as from process_csv
+    Raises LookupError if there is nothing to re-forecast, ValueError if the
+    cached upload needed for a new mapping is gone
+    """
+    db = mongo.get_db()
+    upload = latest_upload(email, fields=('forecast', 'file_path', 'file_paths', 'usage_start', 'usage_end',
+                                          'content_hashes'))
+    if upload is None:
+        raise LookupError("No upload found for this email - please upload a CSV first")
+    
+    ingredients = list(upload['forecast'])
+    if mapping is not None:
+        cache_keys = [key for key in upload.get('content_hashes') or [] if key]
+        frames = [load_cached_sales(key) for key in cache_keys]
+        if not cache_keys or any(frame is None for frame in frames):
+            raise ValueError("The latest upload is no longer cached - please upload the CSV again to apply a new mapping")
+        
+        # Only a mapping that matches something in the upload is stored
+        usage_df = explode_usage(pd.concat(frames, ignore_index=True), build_mapping_table(mapping)).reset_index()
+        if usage_df.empty:
+            raise ValueError("No menu items in the latest upload match the new mapping")
+        store_ingredient_mapping(email, mapping)
+        with metrics.stage('history'):
+            merge_daily_usage(db, email, usage_df)
+        ingredients = list(usage_df['ingredient'].unique())
+    
+    if forecast_model is not None:
+        set_forecast_model(email, forecast_model)
+    model = get_model(get_forecast_model(email), app.config['FORECAST_WINDOW_DAYS'])
+    
+    stock = {ingredient: forecast['current_stock_oz'] for ingredient, forecast in upload['forecast'].items()}
+    stock.update(stock_levels or {})
+    
+    with metrics.stage('history'):
+        history_df = load_trailing_usage(db, email, ingredients, model.history_days).sort_values('date')
+    history_df['date'] = pd.to_datetime(history_df['date'])
+    with metrics.stage('forecast'):
+        forecast_results = compute_forecast(history_df, stock, model=model)
+    
+    result_doc = {key: upload[key] for key in ('file_path', 'file_paths', 'usage_start', 'usage_end',
+                                               'content_hashes') if key in upload}
+    result_doc.update(email=email, processed_at=datetime.utcnow(), forecast=forecast_results,
+                      forecast_model=model.name, source='reforecast')
+    save_upload_result(result_doc)
+    return forecast_results
+
+def find_low_stock(forecast_results):
+    """
+    Ingredients projected to run out within the alert threshold
+    
+    Returns:
+        List of dicts with ingredient, days_remaining, daily_usage
+    """
+    # Get threshold - use test mode if enabled
+    threshold = app.config['LOW_STOCK_THRESHOLD']
+    if app.config.get('TEST_MODE', False):
+        threshold = 999  # Effectively send alerts for all ingredients in test mode
+        logger.warning("TEST MODE ENABLED - Sending alerts for all ingredients")
+    
+    return [
+        {
+            'ingredient': ingredient,
+            'days_remaining': float(forecast['days_remaining']),
+            'daily_usage': float(forecast['daily_avg_usage_oz'])
+        }
+        for ingredient, forecast in forecast_results.items()
+        if forecast['days_remaining'] < threshold
+    ]
+
 def check_and_send_alerts(email, forecast_results):
-    """Check forecast results and send alerts if needed"""
+    """
+    Check forecast results and queue alerts if needed
+    In digest mode (ALERT_DIGEST) all low-stock ingredients go out in one email.
+    Alerts go to the account's recipients (see get_alert_recipients)
+    """
     alerts_sent = []
     alerts_info = {
         'low_stock_items': [],
         'alerts_triggered': 0,
-        'alerts_sent': 0,
+        'alerts_queued': 0,
         'email_configured': False
     }
     
@@ -470,59 +794,188 @@ def check_and_send_alerts(email, forecast_results):
     )
     alerts_info['email_configured'] = email_configured
     
-    # Get threshold - use test mode if enabled
-    threshold = app.config['LOW_STOCK_THRESHOLD']
-    if app.config.get('TEST_MODE', False):
-        threshold = 999  # Effectively send alerts for all ingredients in test mode
-        print("⚠️ TEST MODE ENABLED - Sending alerts for all ingredients")
+    low_stock = find_low_stock(forecast_results)
+    alerts_info['low_stock_items'] = [
+        {'ingredient': item['ingredient'], 'days_remaining': item['days_remaining']} for item in low_stock
+    ]
+    alerts_info['alerts_triggered'] = len(low_stock)
+    
+    if not low_stock:
+        return alerts_sent, alerts_info
+    
+    # Queue alerts for background delivery - the upload doesn't wait on email
+    if app.config['ALERT_DIGEST']:
+        batches = [low_stock]
+    else:
+        batches = [[item] for item in low_stock]
     
-    for ingredient, forecast in forecast_results.items():
-        days_remaining = forecast['days_remaining']
+    recipients = get_alert_recipients(email)
+    for batch in batches:
+        try:
+            if app.config['ALERT_DIGEST']:
+                alert_id = alert_queue.enqueue_digest(email, batch, email_configured, recipients)
+            else:
+                alert_id = alert_queue.enqueue(email=email, email_configured=email_configured,
+                                               recipients=recipients, **batch[0])
+            status = 'queued'
+            alerts_info['alerts_queued'] += 1
+        except Exception as e:
+            alert_id, status = None, f'error: {str(e)}'
         
-        if days_remaining < threshold:
-            alerts_info['low_stock_items'].append({
-                'ingredient': ingredient,
-                'days_remaining': days_remaining
+        for item in batch:
+            alerts_sent.append({
+                'id': alert_id,
+                'ingredient': item['ingredient'],
+                'days_remaining': item['days_remaining'],
+                'status': status
             })
-            alerts_info['alerts_triggered'] += 1
+    
+    return alerts_sent, alerts_info
+
+def save_uploads(files):
+    """
+    Save uploaded files, extracting the CSVs from any zip archives
+    The file limit is checked before anything is written, and files already
+    saved are removed again when the upload is rejected
+    
+    Returns:
+        List of saved CSV paths
+    Raises ValueError for unusable archives or too many files
+    """
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    max_files = app.config['MAX_BATCH_FILES']
+    too_many = f"Too many files - upload at most {max_files} at once"
+    file_paths = []
+    
+    def target(name):
+        path = os.path.join(app.config['UPLOAD_FOLDER'], f"{timestamp}_{len(file_paths)}_{secure_filename(name)}")
+        file_paths.append(path)
+        return path
+    
+    try:
+        for file in files:
+            if not file.filename.lower().endswith('.zip'):
+                if len(file_paths) + 1 > max_files:
+                    raise ValueError(too_many)
+                file.save(target(file.filename))
+                continue
             
-            # Send alert
             try:
-                send_low_stock_alert(
-                    to_email=email,
-                    ingredient=ingredient,
-                    days_remaining=days_remaining,
-                    daily_usage=forecast['daily_avg_usage_oz']
-                )
-                alerts_sent.append({
-                    'ingredient': ingredient,
-                    'days_remaining': days_remaining,
-                    'status': 'sent' if email_configured else 'printed_to_console'
-                })
-                alerts_info['alerts_sent'] += 1
-                
-                # Log alert in MongoDB
-                if db is not None and alerts_collection is not None:
-                    try:
-                        alert_doc = {
-                            'email': email,
-                            'ingredient': ingredient,
-                            'days_remaining': days_remaining,
-                            'sent_at': datetime.utcnow(),
-                            'email_configured': email_configured
-                        }
-                        alerts_collection.insert_one(alert_doc)
-                    except Exception as e:
-                        print(f"⚠ Error logging alert to MongoDB: {e}")
-                    
-            except Exception as e:
-                alerts_sent.append({
-                    'ingredient': ingredient,
-                    'days_remaining': days_remaining,
-                    'status': f'error: {str(e)}'
-                })
+                with zipfile.ZipFile(file.stream) as archive:
+                    members = [info for info in archive.infolist()
+                               if not info.is_dir() and info.filename.lower().endswith('.csv')
+                               and not os.path.basename(info.filename).startswith('.')
+                               and not info.filename.startswith('__MACOSX/')]
+                    if not members:
+                        raise ValueError(f"No CSV files found in {file.filename}")
+                    if len(file_paths) + len(members) > max_files:
+                        raise ValueError(too_many)
+                    if sum(info.file_size for info in members) > app.config['MAX_UNZIPPED_SIZE']:
+                        raise ValueError(f"{file.filename} is too large once extracted")
+                    for info in members:
+                        with archive.open(info) as src, open(target(os.path.basename(info.filename)), 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+            except zipfile.BadZipFile:
+                raise ValueError(f"{file.filename} is not a valid zip archive")
+    except Exception:
+        for path in file_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+    return file_paths
+
+def run_upload(file_paths, email, stock_levels, progress=None, include_usage=True):
+    """
+    Process uploaded CSVs (one or more, merged per day) and queue their alerts
     
-    return alerts_sent, alerts_info
+    Args:
+        include_usage: Embed the daily usage rows for the table view. Job
+            results leave them out (a long history would not fit in a job
+            document) and the page loads them from /api/usage instead
+    
+    Returns:
+        Result dict rendered by the upload page, with the stage timings
+    """
+    with metrics.collect_timings() as timings:
+        # Process CSV
+        forecast_results, usage_df = process_csv_batch(file_paths, email, stock_levels, progress)
+        
+        # Check and send alerts
+        (progress or _no_progress)('alerts')
+        with metrics.stage('alerts'):
+            alerts_sent, alerts_info = check_and_send_alerts(email, forecast_results)
+    
+    # Prepare response data
+    result = {
+        'success': True,
+        'email': email,
+        'forecast': forecast_results,
+        'alerts_sent': alerts_sent,
+        'alerts_info': alerts_info,
+        'usage_range': {  # dates covered by the upload, for /api/usage
+            'start': usage_df['date'].min().date().isoformat(),
+            'end': usage_df['date'].max().date().isoformat()
+        },
+        'timings': dict(timings)
+    }
+    if include_usage:
+        result['usage_data'] = usage_df.to_dict('records')  # Include usage data for table view
+    return result
+
+@app.before_request
+def start_request_timing():
+    """Start timing the request, collecting its stage timings and tagging its logs"""
+    g.request_start = time.perf_counter()
+    g.timings_token = metrics.start_collecting()
+    
+    # Reuse the caller's request id (e.g. from a proxy) when it is a sane token
+    request_id = request.headers.get('X-Request-ID', '')
+    if not (0 < len(request_id) <= 64 and request_id.replace('-', '').isalnum()):
+        request_id = new_correlation_id()
+    g.request_id = request_id
+    g.correlation_token = set_correlation_id(request_id)
+
+@app.after_request
+def add_request_timing(response):
+    """Record request latency and send the stage timings as a Server-Timing header"""
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    metrics.HTTP_REQUEST_SECONDS.labels(
+        endpoint=request.endpoint or 'unmatched', method=request.method, status=response.status_code
+    ).observe(elapsed)
+    
+    timings = dict(metrics.current_timings() or {})
+    timings['total'] = elapsed
+    response.headers['Server-Timing'] = metrics.server_timing_header(timings)
+    response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def stop_request_timing(exc):
+    """Stop collecting stage timings for the finished request"""
+    token = g.pop('timings_token', None)
+    if token is not None:
+        metrics.stop_collecting(token)
+    token = g.pop('correlation_token', None)
+    if token is not None:
+        reset_correlation_id(token)
+
+@app.route('/healthz')
+def healthz():
+    """Liveness and dependency status (the app keeps serving without MongoDB)"""
+    return jsonify({'status': 'ok', 'mongodb': mongo.status})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics, merged across gunicorn workers"""
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    body, content_type = metrics.render_metrics()
+    return body, 200, {'Content-Type': content_type}
 
 @app.route('/')
 def index():
@@ -533,15 +986,11 @@ def index():
 def upload():
     """CSV upload page"""
     if request.method == 'POST':
-        # Check if file was uploaded
-        if 'csv_file' not in request.files:
-            flash('No file selected', 'error')
-            return redirect(request.url)
-        
-        file = request.files['csv_file']
+        # Check if file was uploaded (several CSVs and/or zip archives are accepted)
+        files = [file for file in request.files.getlist('csv_file') if file.filename]
         email = request.form.get('email', '').strip()
         
-        if file.filename == '':
+        if not files:
             flash('No file selected', 'error')
             return redirect(request.url)
         
@@ -549,14 +998,10 @@ def upload():
             flash('Email address is required', 'error')
             return redirect(request.url)
         
-        if file and allowed_file(file.filename):
+        if all(allowed_file(file.filename) for file in files):
             try:
-                # Save file
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                filename = f"{timestamp}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
+                # Save files
+                file_paths = save_uploads(files)
                 
                 # Get stock levels from form (optional)
                 stock_levels = {}
@@ -572,21 +1017,15 @@ def upload():
                         except ValueError:
                             pass
                 
-                # Process CSV
-                forecast_results, usage_df = process_csv(file_path, email, stock_levels)
-                
-                # Check and send alerts
-                alerts_sent, alerts_info = check_and_send_alerts(email, forecast_results)
+                # Process in the background and let the page poll for progress. Jobs
+                # kept in process are only visible to this worker, so without
+                # MongoDB the upload is processed in the request instead
+                if app.config['UPLOAD_JOBS'] and mongo.collection('jobs') is not None:
+                    job_id = upload_jobs.submit('upload', email, run_upload, file_paths, email, stock_levels,
+                                                include_usage=False)
+                    return redirect(url_for('upload_job', job_id=job_id))
                 
-                # Prepare response data
-                response_data = {
-                    'success': True,
-                    'email': email,
-                    'forecast': forecast_results,
-                    'alerts_sent': alerts_sent,
-                    'alerts_info': alerts_info,
-                    'usage_data': usage_df.to_dict('records')  # Include usage data for table view
-                }
+                response_data = run_upload(file_paths, email, stock_levels)
                 
                 flash('Upload successful! Alerts activated.', 'success')
                 return render_template('upload.html', result=response_data)
@@ -595,34 +1034,387 @@ def upload():
                 flash(f'Error processing file: {str(e)}', 'error')
                 return redirect(request.url)
         else:
-            flash('Invalid file type. Please upload a CSV file.', 'error')
+            flash('Invalid file type. Please upload CSV files or a zip of CSV files.', 'error')
             return redirect(request.url)
     
     return render_template('upload.html')
 
+@app.route('/upload/jobs/<job_id>')
+def upload_job(job_id):
+    """Upload progress page; shows the result once the job is done"""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        flash('Upload not found or expired', 'error')
+        return redirect(url_for('upload'))
+    
+    if job['status'] == 'failed':
+        flash(f"Error processing file: {job['error']}", 'error')
+        return redirect(url_for('upload'))
+    
+    if job['status'] == 'done':
+        # The processing stages ran in the job - report them on the page that shows the result
+        for name, seconds in (job['result'].get('timings') or {}).items():
+            metrics.record_timing(f'job_{name}', seconds)
+        flash('Upload successful! Alerts activated.', 'success')
+        return render_template('upload.html', result=job['result'])
+    
+    return render_template('upload.html', job=job_status(job))
+
+def job_status(job):
+    """Public view of a job document"""
+    return {
+        'id': job['_id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'progress': job['progress'],
+        'error': job['error'],
+        'created_at': job['created_at'].isoformat(),
+        'updated_at': job['updated_at'].isoformat()
+    }
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job(job_id):
+    """API endpoint reporting a background job's stage and progress"""
+    job = upload_jobs.get(job_id, include_result=False)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    status = job_status(job)
+    if job['status'] == 'done':
+        status['result_url'] = url_for('upload_job', job_id=job_id)
+    return jsonify(status)
+
 @app.route('/api/forecast', methods=['GET'])
 def api_forecast():
-    """API endpoint to get latest forecast for an email"""
+    """
+    API endpoint to get latest forecast for an email
+    Sends an ETag; pollers that send it back in If-None-Match get a bodyless
+    304 until the forecast is recomputed
+    """
     email = request.args.get('email')
     if not email:
         return jsonify({'error': 'Email parameter required'}), 400
     
-    if db is not None and csv_collection is not None:
+    try:
+        latest = latest_forecast(email)
+    except Exception as e:
+        logger.warning(f"Error reading from MongoDB: {e}")
+        latest = None
+    if not latest:
+        return jsonify({'error': 'No forecast found for this email'}), 404
+    
+    if request.if_none_match.contains(latest['etag']):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({
+            'email': email,
+            'forecast': json_forecast(latest['forecast']),
+            'stock_levels': latest['stock_levels'],
+            'forecast_model': latest['forecast_model'],
+            'processed_at': latest['computed_at'].isoformat()
+        })
+    response.set_etag(latest['etag'])
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate
+    return response
+
+@app.route('/api/reforecast', methods=['POST'])
+def api_reforecast():
+    """
+    API endpoint to recompute the latest forecast from stored usage
+    JSON body: {email, stock_levels: {ingredient: oz}, mapping: {item: {ingredient: oz}},
+    forecast_model: name, send_alerts: bool} - everything but email is optional
+    """
+    data = request.get_json(silent=True) or {}
+    email = str(data.get('email') or '').strip()
+    if not email:
+        return jsonify({'error': 'Email parameter required'}), 400
+    
+    try:
+        stock_levels = {
+            str(ingredient).strip(): float(amount)
+            for ingredient, amount in (data.get('stock_levels') or {}).items()
+            if amount is not None and str(amount).strip() != ''
+        }
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({'error': 'stock_levels must map ingredients to numbers'}), 400
+    if any(amount < 0 for amount in stock_levels.values()):
+        return jsonify({'error': 'Stock levels cannot be negative'}), 400
+    
+    mapping = data.get('mapping')
+    if mapping is not None:
         try:
-            latest = csv_collection.find_one(
-                {'email': email},
-                sort=[('processed_at', -1)]
-            )
-            if latest:
-                return jsonify({
-                    'email': email,
-                    'forecast': latest['forecast'],
-                    'processed_at': latest['processed_at'].isoformat()
-                })
+            mapping = {
+                str(item): {str(ingredient): float(amount) for ingredient, amount in ingredients.items()}
+                for item, ingredients in mapping.items()
+            }
+        except (AttributeError, TypeError, ValueError):
+            return jsonify({'error': 'mapping must map menu items to {ingredient: oz}'}), 400
+    
+    forecast_model = data.get('forecast_model')
+    if forecast_model is not None and forecast_model not in MODELS:
+        return jsonify({'error': f"Unknown forecast model. Choose from: {', '.join(MODELS)}"}), 400
+    
+    try:
+        forecast_results = reforecast(email, stock_levels, mapping, forecast_model)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        logger.exception(f"Error re-forecasting: {e}")
+        return jsonify({'error': 'Could not recompute forecast'}), 500
+    
+    if data.get('send_alerts'):
+        alerts_sent, alerts_info = check_and_send_alerts(email, forecast_results)
+    else:
+        low_stock = find_low_stock(forecast_results)
+        alerts_sent = []
+        alerts_info = {
+            'low_stock_items': [{'ingredient': item['ingredient'], 'days_remaining': item['days_remaining']}
+                                for item in low_stock],
+            'alerts_triggered': len(low_stock),
+            'alerts_queued': 0
+        }
+    
+    return jsonify({
+        'email': email,
+        'forecast_model': get_forecast_model(email),
+        'forecast': json_forecast(forecast_results),
+        'alerts_sent': alerts_sent,
+        'alerts_info': alerts_info
+    })
+
+def json_forecast(forecast_results):
+    """JSON has no Infinity - ingredients with no usage report days_remaining as null"""
+    return {
+        ingredient: dict(values, days_remaining=None if math.isinf(values['days_remaining']) else values['days_remaining'])
+        for ingredient, values in forecast_results.items()
+    }
+
+@app.route('/api/sales', methods=['POST'])
+def api_sales():
+    """
+    API endpoint for POS middleware to push sales with explicit fields
+    Body is either NDJSON (Content-Type application/x-ndjson), one
+    {"date", "item", "quantity"} object per line, streamed in constant memory,
+    or columnar JSON: {"date": [...], "item": [...], "quantity": [...]}
+    Query string: email (required), send_alerts (default true); columnar
+    bodies may also carry email and stock_levels
+    """
+    content_type = request.mimetype
+    payload = {}
+    if content_type == 'application/json':
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return jsonify({'error': 'Body must be a JSON object of date/item/quantity arrays'}), 400
+    elif content_type not in NDJSON_TYPES:
+        return jsonify({'error': 'Send application/x-ndjson or application/json'}), 415
+    
+    email = str(request.args.get('email') or payload.get('email') or '').strip()
+    if not email:
+        return jsonify({'error': 'Email parameter required'}), 400
+    
+    try:
+        stock_levels = {str(ingredient).strip(): float(amount)
+                        for ingredient, amount in (payload.get('stock_levels') or {}).items()}
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({'error': 'stock_levels must map ingredients to numbers'}), 400
+    if any(amount < 0 for amount in stock_levels.values()):
+        return jsonify({'error': 'Stock levels cannot be negative'}), 400
+    
+    # Nothing to detect - straight to daily (date, item, quantity) totals
+    parse_start = time.perf_counter()
+    try:
+        with metrics.stage('parse'):
+            if content_type == 'application/json':
+                sales, rows_received, issues = columnar_sales(payload, app.config['CSV_CHUNK_SIZE'], 'api/sales')
+            else:
+                sales, rows_received, issues = stream_ndjson_sales(request.stream, app.config['CSV_CHUNK_SIZE'],
+                                                                   source='api/sales')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    metrics.observe_parse(rows_received, time.perf_counter() - parse_start)
+    
+    try:
+        forecast_results = process_sales(email, sales, stock_levels)
+    except ValueError as e:
+        return jsonify({'error': str(e), 'rows_received': rows_received, 'row_issues': issues.counts}), 422
+    except Exception as e:
+        logger.exception(f"Error processing pushed sales: {e}")
+        return jsonify({'error': 'Could not process sales'}), 500
+    
+    if request.args.get('send_alerts', 'true').lower() != 'false':
+        with metrics.stage('alerts'):
+            alerts_sent, alerts_info = check_and_send_alerts(email, forecast_results)
+    else:
+        alerts_sent, alerts_info = [], {}
+    
+    return jsonify({
+        'email': email,
+        'rows_received': rows_received,
+        'row_issues': issues.counts,
+        'days': int(sales['date'].nunique()),
+        'forecast_model': get_forecast_model(email),
+        'forecast': json_forecast(forecast_results),
+        'alerts_sent': alerts_sent,
+        'alerts_info': alerts_info
+    })
+
+@app.route('/api/forecast-model', methods=['GET', 'POST'])
+def api_forecast_model():
+    """API endpoint to read or choose an account's forecast model"""
+    data = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+    email = str(data.get('email') or '').strip()
+    if not email:
+        return jsonify({'error': 'Email parameter required'}), 400
+    
+    if request.method == 'POST':
+        model = data.get('forecast_model')
+        if model not in MODELS:
+            return jsonify({'error': f"Unknown forecast model. Choose from: {', '.join(MODELS)}"}), 400
+        try:
+            set_forecast_model(email, model)
+        except Exception as e:
+            logger.warning(f"Error saving account settings: {e}")
+            return jsonify({'error': 'Could not save forecast model'}), 500
+    
+    return jsonify({
+        'email': email,
+        'forecast_model': get_forecast_model(email),
+        'models': [{'name': name, 'description': model.description} for name, model in MODELS.items()]
+    })
+
+@app.route('/api/alert-recipients', methods=['GET', 'POST'])
+def api_alert_recipients():
+    """
+    API endpoint to read or choose the addresses an account's alerts go to
+    POST JSON: {email, recipients: [address, ...]} - an empty list sends
+    alerts to the account email again
+    """
+    data = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+    email = str(data.get('email') or '').strip()
+    if not email:
+        return jsonify({'error': 'Email parameter required'}), 400
+    
+    if request.method == 'POST':
+        try:
+            recipients = set_alert_recipients(email, data.get('recipients'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            logger.warning(f"Error saving account settings: {e}")
+            return jsonify({'error': 'Could not save alert recipients'}), 500
+    else:
+        recipients = get_alert_recipients(email)
+    
+    return jsonify({'email': email, 'recipients': recipients})
+
+@app.route('/api/schema', methods=['GET', 'POST'])
+def api_schema():
+    """
+    API endpoint to read or override the columns read from an account's CSV layouts
+    POST JSON: {email, columns: {date, item, quantity}, date_format, signature} -
+    signature defaults to the most recently seen layout; columns or date_format
+    may be left out to keep the current ones; quantity may be null (1 per row)
+    """
+    data = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+    email = str(data.get('email') or '').strip()
+    if not email:
+        return jsonify({'error': 'Email parameter required'}), 400
+    
+    try:
+        schemas = list_column_schemas(email)
+    except Exception as e:
+        logger.warning(f"Error reading column schemas: {e}")
+        return jsonify({'error': 'Could not read column schemas'}), 500
+    
+    if request.method == 'POST':
+        signature = data.get('signature') or (schemas[0]['signature'] if schemas else None)
+        schema = next((schema for schema in schemas if schema['signature'] == signature), None)
+        if schema is None:
+            return jsonify({'error': 'Unknown CSV layout - upload a CSV with this header first'}), 404
+        
+        requested = data.get('columns', schema['columns'])
+        if not isinstance(requested, dict):
+            return jsonify({'error': 'columns must map date, item and quantity to column names'}), 400
+        columns = {role: str(requested.get(role) or '').strip().strip('"').strip("'").lower() or None
+                   for role in SCHEMA_ROLES}
+        if not columns['date'] or not columns['item']:
+            return jsonify({'error': 'date and item columns are required'}), 400
+        unknown = [column for column in columns.values() if column and column not in schema['header']]
+        if unknown:
+            return jsonify({'error': f"Unknown columns: {', '.join(unknown)}. "
+                                     f"Choose from: {', '.join(schema['header'])}"}), 400
+        
+        # A new date column without a format is parsed with per-chunk inference
+        date_format = data.get('date_format')
+        if date_format is None and columns['date'] == schema['columns'].get('date'):
+            date_format = schema.get('date_format')
+        # Checked against the first values of the date column seen at upload
+        sample = (load_column_schema(email, signature) or {}).get('sample') or []
+        if date_format is not None:
+            position = schema['header'].index(columns['date'])
+            problem = check_date_format(date_format, sample[position] if position < len(sample) else [])
+            if problem:
+                return jsonify({'error': problem}), 400
+        
+        try:
+            save_column_schema(email, signature, schema['header'], columns, date_format, source='override',
+                               sample=sample or None)
         except Exception as e:
-            print(f"⚠ Error reading from MongoDB: {e}")
+            logger.warning(f"Error saving column schema: {e}")
+            return jsonify({'error': 'Could not save column schema'}), 500
+        schemas = list_column_schemas(email)
+    
+    for schema in schemas:
+        schema['updated_at'] = schema['updated_at'].isoformat() if schema.get('updated_at') else None
+    return jsonify({'email': email, 'schemas': schemas})
+
+@app.route('/api/usage', methods=['GET'])
+def api_usage():
+    """API endpoint to get daily ingredient usage history for an email"""
+    email = request.args.get('email')
+    if not email:
+        return jsonify({'error': 'Email parameter required'}), 400
+    
+    # Default to the last 30 days
+    try:
+        end = pd.Timestamp(request.args.get('end') or datetime.utcnow().date())
+        start = pd.Timestamp(request.args.get('start') or end - timedelta(days=29))
+    except ValueError:
+        return jsonify({'error': 'start and end must be dates (YYYY-MM-DD)'}), 400
+    
+    ingredients = request.args.getlist('ingredient') or None
+    try:
+        usage = load_usage_history(mongo.get_db(), email, start, end, ingredients)
+    except Exception as e:
+        logger.warning(f"Error reading usage history: {e}")
+        return jsonify({'error': 'Could not read usage history'}), 500
+    
+    return jsonify({
+        'email': email,
+        'start': start.date().isoformat(),
+        'end': end.date().isoformat(),
+        'usage': [
+            {'date': row.date.date().isoformat(), 'ingredient': row.ingredient, 'usage_oz': round(row.usage_oz, 2)}
+            for row in usage.itertuples(index=False)
+        ]
+    })
+
+@app.route('/api/alerts', methods=['GET'])
+def api_alerts():
+    """API endpoint to poll alert delivery status for an email"""
+    email = request.args.get('email')
+    if not email:
+        return jsonify({'error': 'Email parameter required'}), 400
+    
+    try:
+        alerts = alert_queue.statuses(email, request.args.getlist('id') or None)
+    except Exception as e:
+        logger.warning(f"Error reading alert status: {e}")
+        return jsonify({'error': 'Could not read alert status'}), 500
     
-    return jsonify({'error': 'No forecast found for this email'}), 404
+    return jsonify({'email': email, 'alerts': alerts})
 
 @app.route('/test-email')
 def test_email():
@@ -719,7 +1511,8 @@ def mappings():
         elif action == 'delete':
             item_to_delete = request.form.get('delete_item', '').strip()
             if email and item_to_delete:
-                current_mapping = get_ingredient_mapping(email)
+                # Copy - the returned mapping is shared with the cache
+                current_mapping = dict(get_ingredient_mapping(email))
                 if item_to_delete in current_mapping:
                     del current_mapping[item_to_delete]
                 if item_to_delete.lower() in current_mapping:
@@ -0,0 +1,81 @@
+"""
+Benchmark the forecasting models on a synthetic usage history
+
+Usage:
+    python benchmarks/forecast_models.py [--ingredients 1000] [--days 1095] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from forecasting import MODELS, build_daily_matrix, compute_forecast, get_model
+
+def synthetic_usage(ingredients, days, seed=0):
+    """Daily usage with weekly seasonality, trend and noise; ~10% of days have no usage"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2022-01-01', periods=days)
+    base = rng.uniform(5, 200, ingredients)
+    trend = rng.normal(0, 0.05, ingredients)
+    weekly = 1 + 0.3 * np.sin(2 * np.pi * dates.dayofweek.to_numpy() / 7)
+    usage = base * (1 + trend * np.arange(days)[:, None] / 30) * weekly[:, None]
+    usage *= rng.lognormal(0, 0.2, usage.shape)
+    usage[rng.random(usage.shape) < 0.1] = np.nan
+    
+    frame = pd.DataFrame(usage, index=dates, columns=[f'ingredient_{i}' for i in range(ingredients)])
+    frame = frame.stack().rename('usage_oz').rename_axis(['date', 'ingredient']).reset_index()
+    return frame[frame['usage_oz'] > 0]
+
+def best_of(func, repeat):
+    """Fastest of several runs, in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ingredients', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=3 * 365)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    
+    usage_df = synthetic_usage(args.ingredients, args.days)
+    stock = {ingredient: 5000 for ingredient in usage_df['ingredient'].unique()}
+    daily, in_range = build_daily_matrix(usage_df)
+    
+    results = {
+        'ingredients': args.ingredients,
+        'days': args.days,
+        'usage_rows': len(usage_df),
+        'build_matrix_ms': round(best_of(lambda: build_daily_matrix(usage_df), args.repeat), 2),
+        'models': {}
+    }
+    for name in MODELS:
+        model = get_model(name)
+        results['models'][name] = {
+            'project_ms': round(best_of(lambda: model.project(daily, in_range, 90), args.repeat), 2),
+            'forecast_ms': round(best_of(lambda: compute_forecast(usage_df, stock, model=model), args.repeat), 2)
+        }
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print(f"{args.ingredients} ingredients x {args.days} days ({results['usage_rows']:,} usage rows)")
+    print(f"build matrix: {results['build_matrix_ms']:.1f} ms")
+    print(f"{'model':<14}{'project (ms)':>14}{'full forecast (ms)':>20}")
+    for name, timing in results['models'].items():
+        print(f"{name:<14}{timing['project_ms']:>14.1f}{timing['forecast_ms']:>20.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""
+Benchmark the upload pipeline: CSV detection, parsing, forecasting and alerts
+
+Synthetic Square-style exports are generated once per size (and reused from
+--data-dir on later runs). Each stage records its wall time and peak memory.
+Results are written to JSON so runs from different commits can be compared
+with --compare.
+
+Usage:
+    python benchmarks/pipeline.py [--sizes 10k,1M,10M] [--items 60] [--ingredients 25]
+    python benchmarks/pipeline.py --sizes 10k,1M --compare benchmarks/results/old.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Run without MongoDB or a real email transport, and parse every upload cold
+os.environ['MONGODB_URI'] = ''
+os.environ['SENDGRID_API_KEY'] = ''
+os.environ['SMTP_USERNAME'] = ''
+os.environ.setdefault('PARSED_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'stockwise-bench-parsed'))
+
+import app as stockwise
+from csv_ingest import detect_csv_format
+from forecasting import compute_forecast, get_model
+
+# process_csv always runs - the later stages use its output
+OPTIONAL_STAGES = ('detect_csv_format', 'forecast', 'check_and_send_alerts')
+
+SQUARE_HEADER = ['Date', 'Time', 'Time Zone', 'Category', 'Item', 'Qty', 'Price Point Name', 'SKU',
+                 'Modifiers Applied', 'Gross Sales', 'Discounts', 'Net Sales', 'Tax', 'Transaction ID',
+                 'Location']
+CATEGORIES = ['Coffee', 'Tea', 'Bakery', 'Cold Drinks', 'Seasonal']
+
+def parse_size(text):
+    """'10k' -> 10000, '1M' -> 1000000"""
+    text = text.strip().lower()
+    for suffix, factor in (('k', 10 ** 3), ('m', 10 ** 6)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+def synthetic_mapping(items, ingredients, seed=0):
+    """Menu items using one to four ingredients each"""
+    rng = np.random.default_rng(seed)
+    ingredient_names = [f'ingredient_{i:03d}' for i in range(ingredients)]
+    mapping = {}
+    for i in range(items):
+        used = rng.choice(ingredients, size=min(ingredients, rng.integers(1, 5)), replace=False)
+        mapping[f'Menu Item {i:03d}'] = {ingredient_names[j]: round(float(rng.uniform(0.5, 12)), 1) for j in used}
+    return mapping
+
+def write_square_csv(path, rows, items, days=365, seed=0, chunk_size=500_000):
+    """Write a Square POS style item sales export with `rows` line items"""
+    rng = np.random.default_rng(seed)
+    item_names = np.array([f'Menu Item {i:03d}' for i in range(items)])
+    # A few best sellers and a long tail, like real menus
+    popularity = rng.zipf(1.5, items).astype(float)
+    popularity /= popularity.sum()
+    start = np.datetime64('2023-01-01')
+    
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        f.write(','.join(SQUARE_HEADER) + '\n')
+        for offset in range(0, rows, chunk_size):
+            n = min(chunk_size, rows - offset)
+            item_idx = rng.choice(items, size=n, p=popularity)
+            qty = rng.integers(1, 4, n)
+            price = np.round(rng.uniform(2.5, 7.5, items), 2)[item_idx]
+            seconds = rng.integers(6 * 3600, 20 * 3600, n)
+            chunk = pd.DataFrame({
+                'Date': (start + np.sort(rng.integers(0, days, n))).astype(str),
+                'Time': pd.to_datetime(seconds, unit='s').strftime('%H:%M:%S'),
+                'Time Zone': 'Eastern Time (US & Canada)',
+                'Category': np.array(CATEGORIES)[item_idx % len(CATEGORIES)],
+                'Item': item_names[item_idx],
+                'Qty': qty,
+                'Price Point Name': 'Regular',
+                'SKU': '',
+                'Modifiers Applied': np.where(rng.random(n) < 0.2, 'Oat Milk', ''),
+                'Gross Sales': ['${:.2f}'.format(value) for value in price * qty],
+                'Discounts': '$0.00',
+                'Net Sales': ['${:.2f}'.format(value) for value in price * qty],
+                'Tax': ['${:.2f}'.format(value) for value in price * qty * 0.08],
+                'Transaction ID': rng.integers(10 ** 11, 10 ** 12, n).astype(str),
+                'Location': 'Main Street'
+            })
+            chunk.to_csv(f, header=False, index=False)
+    os.replace(tmp_path, path)
+
+def dataset(data_dir, rows, items, seed):
+    """Path of the synthetic export for these parameters, generated if missing"""
+    path = os.path.join(data_dir, f'square_{rows}_rows_{items}_items_seed{seed}.csv')
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        start = time.perf_counter()
+        write_square_csv(path, rows, items, seed=seed)
+        print(f"  generated {os.path.basename(path)} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return path
+
+class StubTransport:
+    """Stands in for SendGrid/SMTP: records sends after an optional delay"""
+    
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = 0
+    
+    def send(self, **kwargs):
+        time.sleep(self.latency)
+        self.sent += 1
+        return 'stub'
+    
+    def send_digest(self, **kwargs):
+        return self.send(**kwargs)
+
+class PeakMemory:
+    """
+    Peak memory used while the block runs, in MB above the starting point
+    Samples the process RSS from a background thread where /proc is available
+    (covers pandas/numpy buffers at no cost to the measured code); elsewhere
+    falls back to tracemalloc, which only sees Python allocations
+    """
+    
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_mb = None
+        self._use_proc = os.path.exists('/proc/self/statm')
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if self._use_proc else None
+        self._stop = threading.Event()
+    
+    def _rss(self):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * self._page_size
+    
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._max = max(self._max, self._rss())
+    
+    def __enter__(self):
+        if self._use_proc:
+            self._start = self._max = self._rss()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        else:
+            tracemalloc.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self._use_proc:
+            self._stop.set()
+            self._thread.join()
+            peak = max(self._max, self._rss()) - self._start
+        else:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.peak_mb = round(peak / 2 ** 20, 2)
+
+def measure(func, memory=True):
+    """Run func once, recording its wall time and (optionally) peak memory"""
+    gc.collect()
+    if not memory:
+        start = time.perf_counter()
+        result = func()
+        return {'seconds': round(time.perf_counter() - start, 4)}, result
+    
+    with PeakMemory() as peak:
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+    return {'seconds': round(seconds, 4), 'peak_mb': peak.peak_mb}, result
+
+def wait_for_alerts(email, alert_ids, timeout=60):
+    """Block until every queued alert reached a final status"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        statuses = stockwise.alert_queue.statuses(email, alert_ids, limit=len(alert_ids))
+        if all(status['status'] in ('sent', 'printed_to_console', 'failed') for status in statuses):
+            return True
+        time.sleep(0.01)
+    return False
+
+def run_size(rows, args, transport):
+    """Benchmark every stage on one synthetic export"""
+    path = dataset(args.data_dir, rows, args.items, args.seed)
+    email = f'bench-{rows}@example.com'  # fresh usage history per size
+    model = get_model(args.model, stockwise.app.config['FORECAST_WINDOW_DAYS'])
+    stockwise.set_forecast_model(email, model.name)
+    
+    # Stock that runs out in under a week for roughly a third of the ingredients
+    rng = np.random.default_rng(args.seed)
+    stock_levels = {ingredient: float(rng.choice([10, 10 ** 7], p=[0.3, 0.7]))
+                    for ingredient in sorted({ingredient for recipe in stockwise.DEFAULT_INGREDIENT_MAPPING.values()
+                                              for ingredient in recipe})}
+    
+    result = {'rows': rows, 'file_mb': round(os.path.getsize(path) / 2 ** 20, 2), 'stages': {}}
+    stages = result['stages']
+    memory = not args.no_memory
+    
+    if 'detect_csv_format' not in args.skip:
+        stages['detect_csv_format'], df = measure(lambda: detect_csv_format(path), memory)
+        stages['detect_csv_format']['rows_read'] = len(df)
+        del df
+    
+    stages['process_csv'], (forecast, usage_df) = measure(
+        lambda: stockwise.process_csv(path, email, stock_levels), memory)
+    stages['process_csv']['usage_rows'] = len(usage_df)
+    
+    if 'forecast' not in args.skip:
+        stages['forecast'], _ = measure(lambda: compute_forecast(usage_df, stock_levels, model=model), memory)
+        stages['forecast'].update(model=model.name, ingredients=len(forecast))
+    
+    if 'check_and_send_alerts' not in args.skip:
+        sent_before = transport.sent
+        stages['check_and_send_alerts'], (alerts_sent, alerts_info) = measure(
+            lambda: stockwise.check_and_send_alerts(email, forecast), memory=False)
+        alert_ids = sorted({alert['id'] for alert in alerts_sent if alert['id']})
+        start = time.perf_counter()
+        delivered = wait_for_alerts(email, alert_ids)
+        stages['check_and_send_alerts'].update(
+            low_stock=alerts_info['alerts_triggered'],
+            alerts_queued=alerts_info['alerts_queued'],
+            delivery_seconds=round(time.perf_counter() - start, 4) if delivered else None,
+            sends=transport.sent - sent_before
+        )
+    
+    return result
+
+def git_commit():
+    """Current commit (with -dirty for uncommitted changes), or None outside git"""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    """Print the change in time and peak memory against an earlier results file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    baseline_runs = {run['rows']: run for run in baseline['runs']}
+    
+    print(f"\nCompared with {baseline.get('commit')} ({baseline_path}):")
+    for run in results['runs']:
+        old_run = baseline_runs.get(run['rows'])
+        if old_run is None:
+            continue
+        for stage, stats in run['stages'].items():
+            old = old_run['stages'].get(stage)
+            if not old:
+                continue
+            changes = []
+            for metric in ('seconds', 'peak_mb'):
+                if stats.get(metric) and old.get(metric):
+                    changes.append(f"{metric} {old[metric]} -> {stats[metric]} ({stats[metric] / old[metric] - 1:+.0%})")
+            if changes:
+                print(f"  {run['rows']:>10,} rows  {stage:<22} " + ', '.join(changes))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10k,1M,10M', help='comma separated row counts (default: 10k,1M,10M)')
+    parser.add_argument('--items', type=int, default=60, help='distinct menu items in the exports')
+    parser.add_argument('--ingredients', type=int, default=25, help='distinct ingredients in the mapping')
+    parser.add_argument('--model', default=None, help='forecast model (default: Config.FORECAST_MODEL)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--transport-latency', type=float, default=0.0, help='seconds per stubbed send')
+    parser.add_argument('--skip', default='', help=f"comma separated stages to skip: {', '.join(OPTIONAL_STAGES)}")
+    parser.add_argument('--no-memory', action='store_true', help='do not record peak memory')
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, 'benchmarks', 'data'))
+    parser.add_argument('--output', default=None, help='results file (default: benchmarks/results/pipeline-<commit>.json)')
+    parser.add_argument('--compare', default=None, help='earlier results file to compare against')
+    args = parser.parse_args()
+    args.skip = {stage.strip() for stage in args.skip.split(',') if stage.strip()}
+    if args.skip - set(OPTIONAL_STAGES):
+        parser.error(f"unknown stage(s) to skip: {', '.join(sorted(args.skip - set(OPTIONAL_STAGES)))}")
+    args.model = args.model or stockwise.app.config['FORECAST_MODEL']
+    
+    # Synthetic menu, stubbed email transport, no parsed-cache hits
+    stockwise.DEFAULT_INGREDIENT_MAPPING.clear()
+    stockwise.DEFAULT_INGREDIENT_MAPPING.update(synthetic_mapping(args.items, args.ingredients, args.seed))
+    stockwise._mapping_cache.clear()
+    stockwise.app.config['PARSED_CACHE'] = False
+    stockwise.app.config['TEST_MODE'] = False
+    transport = StubTransport(args.transport_latency)
+    stockwise.alert_queue.send = transport.send
+    stockwise.alert_queue.send_digest = transport.send_digest
+    
+    results = {
+        'commit': git_commit(),
+        'created_at': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'cpus': os.cpu_count(),
+        'params': {'items': args.items, 'ingredients': args.ingredients, 'model': args.model,
+                   'seed': args.seed, 'transport_latency': args.transport_latency,
+                   'alert_digest': stockwise.app.config['ALERT_DIGEST'], 'memory': not args.no_memory},
+        'runs': []
+    }
+    
+    for rows in [parse_size(size) for size in args.sizes.split(',')]:
+        print(f"{rows:,} rows...", file=sys.stderr)
+        run = run_size(rows, args, transport)
+        results['runs'].append(run)
+        for stage, stats in run['stages'].items():
+            peak = f"  peak {stats['peak_mb']:.1f} MB" if 'peak_mb' in stats else ''
+            print(f"  {stage:<22} {stats['seconds']:>9.3f}s{peak}", file=sys.stderr)
+    
+    # Whole-process high-water mark (kilobytes on Linux)
+    results['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"pipeline-{results['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+    
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
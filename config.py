@@ -15,24 +15,79 @@ class Config:
     # MongoDB configuration
     MONGODB_URI = os.environ.get('MONGODB_URI') or 'mongodb://localhost:27017/'
     MONGODB_DB_NAME = os.environ.get('MONGODB_DB_NAME') or 'stockwise'
+    # Connection pool per worker process; the client connects lazily on first use
+    MONGODB_MAX_POOL_SIZE = int(os.environ.get('MONGODB_MAX_POOL_SIZE') or 10)
+    MONGODB_MIN_POOL_SIZE = int(os.environ.get('MONGODB_MIN_POOL_SIZE') or 0)
+    MONGODB_MAX_IDLE_MS = int(os.environ.get('MONGODB_MAX_IDLE_MS') or 60000)
+    # Timeouts (ms); the heartbeat sets how quickly an outage or recovery is noticed
+    MONGODB_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGODB_CONNECT_TIMEOUT_MS') or 5000)
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGODB_SERVER_SELECTION_TIMEOUT_MS') or 5000)
+    MONGODB_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGODB_SOCKET_TIMEOUT_MS') or 60000)
+    MONGODB_HEARTBEAT_MS = int(os.environ.get('MONGODB_HEARTBEAT_MS') or 10000)
     
     # Email configuration (SendGrid)
     SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY') or ''
     ALERT_EMAIL_FROM = os.environ.get('ALERT_EMAIL_FROM') or 'alerts@stockwise.com'
+    SENDGRID_TIMEOUT = 30  # seconds to wait for the API response
+    SENDGRID_RETRIES = 3  # retries on connection errors, 429 and 5xx
+    SENDGRID_POOL_SIZE = int(os.environ.get('SENDGRID_POOL_SIZE') or 4)  # keep-alive connections
     
     # SMTP configuration (alternative to SendGrid)
     SMTP_SERVER = os.environ.get('SMTP_SERVER') or 'smtp.gmail.com'
     SMTP_PORT = int(os.environ.get('SMTP_PORT') or 587)
     SMTP_USERNAME = os.environ.get('SMTP_USERNAME') or ''
     SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD') or ''
+    SMTP_TIMEOUT = 30  # seconds per SMTP operation
+    SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE') or 2)  # idle sessions kept open
+    SMTP_IDLE_TIMEOUT = int(os.environ.get('SMTP_IDLE_TIMEOUT') or 60)  # seconds before an idle session is closed
     
     # Alert threshold (days)
     LOW_STOCK_THRESHOLD = 2  # Alert when ingredient projected to run out in < 2 days
     
+    # Forecast - model history window (days) and default model
+    FORECAST_WINDOW_DAYS = 7
+    FORECAST_MODEL = os.environ.get('FORECAST_MODEL') or 'rolling_mean'  # default for accounts without a choice
+    
+    # Background alert delivery
+    ALERT_DIGEST = os.environ.get('ALERT_DIGEST', 'True').lower() == 'true'  # one email per upload
+    ALERT_WORKERS = int(os.environ.get('ALERT_WORKERS') or 2)  # sender threads per process
+    ALERT_MAX_ATTEMPTS = 5
+    ALERT_RETRY_BASE_SECONDS = 5  # first retry delay, doubles on every attempt
+    MAX_ALERT_RECIPIENTS = 20  # addresses an account's alerts can go to
+    
     # Test mode - set to True to send alerts for all ingredients (for testing)
     TEST_MODE = os.environ.get('TEST_MODE', 'False').lower() == 'true'
     
     # Upload settings
+    UPLOAD_JOBS = os.environ.get('UPLOAD_JOBS', 'True').lower() == 'true'  # process uploads in the background (needs MongoDB)
+    UPLOAD_JOB_WORKERS = int(os.environ.get('UPLOAD_JOB_WORKERS') or 2)  # job threads per process
+    UPLOAD_JOB_LEASE_SECONDS = 120  # a job not updated for this long is reported as failed
+    UPLOAD_JOB_TTL_SECONDS = int(os.environ.get('UPLOAD_JOB_TTL_SECONDS') or 24 * 3600)  # job documents (with results) expire
     UPLOAD_FOLDER = 'uploads'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
-    ALLOWED_EXTENSIONS = {'csv'}
+    ALLOWED_EXTENSIONS = {'csv', 'zip'}
+    MAX_BATCH_FILES = 50  # CSVs per upload (zip contents included)
+    MAX_UNZIPPED_SIZE = 512 * 1024 * 1024  # 512MB extracted per zip archive
+    PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS') or os.cpu_count() or 1)  # processes for batch uploads
+    
+    # CSV ingestion - stream large files in fixed-size chunks (C parser)
+    STREAMING_INGEST = os.environ.get('STREAMING_INGEST', 'True').lower() == 'true'
+    CSV_CHUNK_SIZE = int(os.environ.get('CSV_CHUNK_SIZE') or 100000)  # rows per chunk
+    CSV_SNIFF_BYTES = 8 * 1024  # sample size used to detect the format
+    CSV_FORMAT_CACHE_SIZE = 1000  # uploaders whose detected format is remembered
+    
+    # Parsed upload cache - daily (date, item, quantity) frames as Parquet, keyed by content hash
+    PARSED_CACHE = os.environ.get('PARSED_CACHE', 'True').lower() == 'true'
+    PARSED_CACHE_DIR = os.environ.get('PARSED_CACHE_DIR') or os.path.join('uploads', '.parsed')
+    PARSED_CACHE_MAX_BYTES = int(os.environ.get('PARSED_CACHE_MAX_BYTES') or 256 * 1024 * 1024)
+    
+    # Logging: level name and 'text' or 'json' lines
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'text'
+    
+    # Prometheus /metrics endpoint (requires "Authorization: Bearer <token>" when set)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or ''
+    
+    # Ingredient mapping cache (per worker, validated against the mapping version)
+    MAPPING_CACHE_SIZE = 1000
+    MAPPING_CACHE_TTL = int(os.environ.get('MAPPING_CACHE_TTL') or 300)  # seconds
@@ -0,0 +1,794 @@
+"""
+CSV ingestion: format detection, column resolution and daily usage aggregation
+Kept free of Flask/MongoDB state so files can also be parsed in worker processes
+"""
+import csv
+import hashlib
+import importlib.util
+import os
+import re
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+import pandas as pd
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:  # pandas < 2.2
+    from pandas._libs.tslibs.parsing import guess_datetime_format
+
+from config import Config
+from cache import LRUCache
+from log import RowIssues, get_logger
+
+logger = get_logger('ingest')
+
+# Square POS common formats:
+# 1. Standard CSV with headers
+# 2. TSV (tab-separated)
+# 3. Excel-exported CSV (may have BOM)
+# 4. Quoted rows format ('"date,item,qty"')
+# 5. Report title / blank lines above the header row
+CSV_ENCODINGS = ['utf-8-sig', 'utf-8', 'latin-1', 'iso-8859-1', 'cp1252']
+CSV_DELIMITERS = [',', '\t', ';', '|']
+SQUARE_POS_KEYWORDS = ['item name', 'item_name', 'product name', 'sku',
+                       'quantity sold', 'net sales', 'gross sales']
+
+SALES_COLUMNS = ['date', 'item', 'quantity']
+SCHEMA_ROLES = ('date', 'item', 'quantity')  # order of resolve_columns()' result
+
+# Date formats tried after pandas' guess from the first values (US month-first
+# before day-first; a day above 12 in the sample settles it)
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S',
+                '%m/%d/%Y', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M', '%m/%d/%Y %I:%M %p',
+                '%m/%d/%y', '%m/%d/%y %H:%M', '%m/%d/%y %I:%M %p',
+                '%d/%m/%Y', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d/%m/%y',
+                '%d.%m.%Y', '%Y/%m/%d', '%b %d, %Y', '%d %b %Y']
+DATE_SAMPLE_ROWS = 200  # rows used to infer a file's date format
+DATE_DIRECTIVES = ('%d', '%m', '%Y', '%y', '%b', '%B')  # a date format needs at least one
+SCHEMA_SAMPLE_ROWS = 20  # values per column stored with a schema (to check date format overrides)
+MAX_DATE_FORMATS = 3  # formats tried per chunk before per-value parsing
+
+# Bump when parsing changes so stale parsed-cache entries are never reused
+PARSED_CACHE_VERSION = '1'
+_parquet_support = None  # see _parquet_available()
+
+# Detected CSV formats per uploader: {email: fingerprint}
+_csv_format_cache = LRUCache(maxsize=Config.CSV_FORMAT_CACHE_SIZE)
+
+def _unquote_row(line):
+    """Strip quotes wrapping an entire row: '"a,b,c"' -> 'a,b,c'"""
+    line = line.rstrip('\r\n')
+    if len(line) >= 2 and line[0] == '"' and line[-1] == '"':
+        line = line[1:-1]
+    return line + '\n'
+
+class _UnquotedRows:
+    """File-like wrapper that unquotes whole-row-quoted files on the fly"""
+    
+    def __init__(self, f):
+        self._f = f
+    
+    def read(self, size=-1):
+        return ''.join(_unquote_row(line) for line in self._f.readlines(size if size and size > 0 else -1))
+    
+    def readline(self):
+        line = self._f.readline()
+        return _unquote_row(line) if line else line
+    
+    def __iter__(self):
+        return (_unquote_row(line) for line in self._f)
+
+def _header_signature(header_line):
+    """Stable signature of a header line, used to recognise repeat layouts"""
+    return hashlib.md5(header_line.strip().encode('utf-8')).hexdigest()
+
+def sniff_csv_format(file_path, sample_size=None, encodings=None):
+    """
+    Detect the CSV format from a bounded byte sample - no full parse
+    Works out encoding, delimiter, whole-row quoting and header row
+    
+    Args:
+        encodings: Candidate encodings in order (defaults to CSV_ENCODINGS)
+    
+    Returns:
+        Format fingerprint dict (JSON-serializable, safe to cache)
+    Raises ValueError if the sample doesn't look like a delimited file
+    """
+    sample_size = sample_size or Config.CSV_SNIFF_BYTES
+    with open(file_path, 'rb') as f:
+        raw = f.read(sample_size)
+        at_eof = not f.read(1)
+    
+    # Only keep complete lines so we never split a row or a multi-byte character
+    if not at_eof and b'\n' in raw:
+        raw = raw[:raw.rindex(b'\n') + 1]
+    
+    for encoding in encodings or CSV_ENCODINGS:
+        try:
+            text = raw.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError("Could not detect the CSV file's text encoding")
+    
+    lines = text.splitlines()
+    non_blank = [line for line in lines if line.strip()]
+    if not non_blank:
+        raise ValueError("CSV file is empty or could not be parsed")
+    
+    # Rows wrapped entirely in quotes parse as a single field containing delimiters
+    first_fields = next(csv.reader([non_blank[0]]))
+    quoted_rows = (
+        len(first_fields) == 1
+        and any(d in first_fields[0] for d in CSV_DELIMITERS)
+        and all(line.strip().startswith('"') and line.strip().endswith('"') for line in non_blank[:20])
+    )
+    if quoted_rows:
+        lines = [_unquote_row(line).rstrip('\n') for line in lines]
+    
+    # Pick the delimiter giving the most consistent multi-column field count
+    best = None
+    for delimiter in CSV_DELIMITERS:
+        counts = Counter(
+            len(fields) for fields in csv.reader(
+                (line for line in lines if line.strip()), delimiter=delimiter, skipinitialspace=True
+            )
+        )
+        for field_count, rows in counts.most_common():
+            if field_count > 1:
+                if best is None or (rows, field_count) > (best[2], best[1]):
+                    best = (delimiter, field_count, rows)
+                break
+    if best is None:
+        try:
+            delimiter = csv.Sniffer().sniff(text).delimiter
+        except csv.Error:
+            raise ValueError("Could not detect a delimited CSV format")
+        best = (delimiter, None, 0)
+    delimiter, field_count = best[0], best[1]
+    
+    # Header is the first line with the full field count (skips report titles/blank lines)
+    header_row = 0
+    if field_count:
+        for i, line in enumerate(lines):
+            if line.strip() and len(next(csv.reader([line], delimiter=delimiter))) == field_count:
+                header_row = i
+                break
+    
+    header_text = '\n'.join(lines[header_row:header_row + 3]).lower()
+    return {
+        'encoding': encoding,
+        'delimiter': delimiter,
+        'quoted_rows': quoted_rows,
+        'header_row': header_row,
+        'signature': _header_signature(lines[header_row]),
+        'square_pos': any(keyword in header_text for keyword in SQUARE_POS_KEYWORDS)
+    }
+
+def read_header_signature(file_path, fingerprint):
+    """Signature of the header line of a file, read using a known fingerprint"""
+    with open(file_path, 'r', encoding=fingerprint['encoding'], errors='replace', newline='') as f:
+        for _ in range(fingerprint['header_row']):
+            f.readline()
+        header_line = f.readline()
+    if fingerprint['quoted_rows']:
+        header_line = _unquote_row(header_line)
+    return _header_signature(header_line)
+
+def get_csv_format(file_path, email=None):
+    """
+    Get the format fingerprint for a file, reusing the uploader's cached
+    fingerprint when the header matches (repeat uploads of the same export
+    layout skip detection entirely)
+    """
+    if email:
+        cached = _csv_format_cache.get(email)
+        if cached is not None:
+            try:
+                if read_header_signature(file_path, cached) == cached['signature']:
+                    logger.info("Reusing cached CSV format")
+                    return cached
+            except (OSError, UnicodeError):
+                pass
+    
+    fingerprint = sniff_csv_format(file_path)
+    logger.info(f"Detected CSV format: {fingerprint['encoding']} encoding, {fingerprint['delimiter']!r} delimiter"
+                + (" (Square POS)" if fingerprint['square_pos'] else ''))
+    
+    if email:
+        _csv_format_cache.set(email, fingerprint)
+    return fingerprint
+
+def forget_csv_format(email):
+    """Drop an uploader's cached fingerprint (e.g. its encoding turned out wrong)"""
+    _csv_format_cache.invalidate(email)
+
+def fallback_csv_format(file_path, fingerprint):
+    """
+    Re-detect the format with the encodings after the fingerprint's one
+    The encoding is chosen from the first bytes only, so a file whose first
+    non-UTF-8 byte comes later fails to decode part way through; it is read
+    again as the next candidate (latin-1, which decodes any byte) rather
+    than with undecodable bytes replaced. Columns and date format attached
+    to the fingerprint are kept.
+    
+    Returns:
+        New fingerprint, or None if there is no other encoding to try
+    """
+    encoding = fingerprint['encoding']
+    remaining = CSV_ENCODINGS[CSV_ENCODINGS.index(encoding) + 1:] if encoding in CSV_ENCODINGS else []
+    if encoding.startswith('utf'):
+        remaining = [candidate for candidate in remaining if not candidate.startswith('utf')]
+    if not remaining:
+        return None
+    return dict(fingerprint, **sniff_csv_format(file_path, encodings=remaining))
+
+def with_encoding_fallback(read, file_path, fingerprint):
+    """
+    Call read(fingerprint), switching to the next candidate encoding each
+    time it hits bytes the fingerprint's encoding can't decode
+    
+    Returns:
+        (read's result, fingerprint it succeeded with)
+    """
+    while True:
+        try:
+            return read(fingerprint), fingerprint
+        except UnicodeDecodeError as e:
+            fallback = fallback_csv_format(file_path, fingerprint)
+            if fallback is None:
+                raise
+            logger.warning(f"{os.path.basename(file_path)} is not {fingerprint['encoding']} ({e}) - "
+                           f"reading it as {fallback['encoding']}")
+            fingerprint = fallback
+
+@contextmanager
+def open_csv(file_path, fingerprint, errors='strict', **read_kwargs):
+    """
+    Parse a CSV with pd.read_csv using a format fingerprint
+    Extra keyword arguments (chunksize, usecols, engine, ...) go to pd.read_csv
+    """
+    options = dict(delimiter=fingerprint['delimiter'], quotechar='"',
+                   skipinitialspace=True, on_bad_lines='skip',
+                   skip_blank_lines=True, skiprows=fingerprint['header_row'])
+    options.update(read_kwargs)
+    
+    if fingerprint['quoted_rows']:
+        with open(file_path, 'r', encoding=fingerprint['encoding'], errors=errors, newline='') as f:
+            yield pd.read_csv(_UnquotedRows(f), **options)
+    else:
+        yield pd.read_csv(file_path, encoding=fingerprint['encoding'],
+                          encoding_errors=errors, **options)
+
+def detect_csv_format(file_path, fingerprint=None):
+    """
+    Read a whole CSV into a DataFrame
+    The format comes from the fingerprint (detected from a sample if not given)
+    and the file is parsed exactly once with the tolerant python engine.
+    Raises UnicodeDecodeError if the file isn't in the fingerprint's encoding
+    """
+    if fingerprint is None:
+        fingerprint = sniff_csv_format(file_path)
+    
+    with open_csv(file_path, fingerprint, engine='python') as df:
+        pass
+    
+    # Clean up Square POS specific issues
+    if not df.empty:
+        # Remove completely empty rows
+        df = df.dropna(how='all')
+        # Remove rows where all values are the same (often headers repeated)
+        if len(df) > 1:
+            df = df[df.astype(str).nunique(axis=1) > 1]
+    
+    return df
+
+class KeywordIndex:
+    """
+    Keyword rules for one column role, compiled once
+    A column's rank is that of the best keyword it contains (case-insensitive,
+    partial match); the best column is the lowest rank, then leftmost - the
+    same choice as scanning keyword by keyword over all columns
+    
+    Args:
+        keywords: Keywords in priority order (duplicates ignored)
+    """
+    
+    def __init__(self, keywords):
+        self.ranks = {}
+        for keyword in keywords:
+            self.ranks.setdefault(keyword.lower(), len(self.ranks))
+        # Lookahead finds overlapping matches ('time' inside 'timestamp'); at each
+        # position the alternation tries better-ranked keywords first
+        self.pattern = re.compile('(?=(' + '|'.join(re.escape(keyword) for keyword in self.ranks) + '))')
+    
+    def rank(self, column):
+        """Rank of the best keyword in a column name, or None"""
+        return min((self.ranks[match.group(1)] for match in self.pattern.finditer(column.lower())), default=None)
+    
+    def best(self, columns):
+        """Best matching column name, or None"""
+        ranked = [(rank, position) for position, rank in enumerate(map(self.rank, columns)) if rank is not None]
+        return columns[min(ranked)[1]] if ranked else None
+
+# Column roles and their keywords, best first
+COLUMN_RULES = {
+    'date': KeywordIndex(['date', 'time', 'timestamp',
+                          'created', 'sold', 'order', 'day', 'when', 'dt']),
+    'item': KeywordIndex(['item', 'product', 'name',
+                          'menu', 'sku', 'description', 'title', 'product_name', 'item_name']),
+    'quantity': KeywordIndex(['quantity', 'qty', 'amount',
+                              'count', 'units', 'num', 'number'])
+}
+
+@lru_cache(maxsize=64)
+def _keyword_index(keywords):
+    return KeywordIndex(keywords)
+
+def find_column_by_keywords(df, keywords_list, priority_order=None):
+    """
+    Find column by matching keywords (case-insensitive, partial match)
+    Returns best match based on priority
+    """
+    keywords = tuple(priority_order or ()) + tuple(keyword for keywords in keywords_list for keyword in keywords)
+    return _keyword_index(keywords).best(list(df.columns))
+
+@lru_cache(maxsize=1024)
+def match_columns(columns):
+    """
+    Keyword-matched (date, item, quantity) columns for a header (tuple of
+    normalized names); None where no keyword matches. Memoized per header
+    """
+    return tuple(COLUMN_RULES[role].best(list(columns)) for role in SCHEMA_ROLES)
+
+def normalize_columns(columns):
+    """Normalize column names: strip whitespace/quotes and lowercase"""
+    return columns.str.strip().str.strip('"').str.strip("'").str.lower()
+
+def resolve_columns(df):
+    """
+    Intelligently find the date, item and quantity columns using multiple strategies
+    Only needs the header and a few sample rows (used for the date fallback)
+    
+    Returns:
+        (date_col, item_col, qty_col) - qty_col may be None
+    """
+    # Date, item and quantity columns by keyword (see COLUMN_RULES)
+    date_col, item_col, qty_col = match_columns(tuple(df.columns))
+    
+    # If still not found, try using first few columns as fallback
+    if not date_col and len(df.columns) > 0:
+        # Check if first column looks like dates
+        first_col = df.columns[0]
+        sample_values = df[first_col].head(5).astype(str)
+        if pd.to_datetime(sample_values, errors='coerce').notna().any():
+            date_col = first_col
+    
+    if not item_col and len(df.columns) > 1:
+        # Use second column as item if date was first
+        if date_col == df.columns[0] and len(df.columns) > 1:
+            item_col = df.columns[1]
+        else:
+            item_col = df.columns[0] if df.columns[0] != date_col else (df.columns[1] if len(df.columns) > 1 else None)
+    
+    if not date_col or not item_col:
+        available_cols = ', '.join(df.columns.tolist())
+        raise ValueError(
+            f"Could not automatically detect required columns.\n"
+            f"Found columns: {available_cols}\n"
+            f"Please ensure your CSV has date/time and item/product columns."
+        )
+    
+    return date_col, item_col, qty_col
+
+def read_column_sample(file_path, fingerprint, nrows=DATE_SAMPLE_ROWS):
+    """
+    Header and first rows of a file
+    
+    Returns:
+        (raw column names, sample DataFrame with normalized column names)
+    """
+    with open_csv(file_path, fingerprint, dtype=str, nrows=nrows) as sample_df:
+        raw_columns = sample_df.columns
+    sample_df.columns = normalize_columns(sample_df.columns)
+    return raw_columns, sample_df
+
+def detect_schema(file_path, fingerprint, columns=None):
+    """
+    Resolve a file's columns and date format from its header and first rows
+    
+    Args:
+        columns: Known {role: column} mapping - only the date format is inferred
+    
+    Returns:
+        (normalized header list, {'date': col, 'item': col, 'quantity': col or None},
+         date format or None, column sample - see column_sample())
+    """
+    _, sample_df = read_column_sample(file_path, fingerprint)
+    if columns is None:
+        columns = dict(zip(SCHEMA_ROLES, resolve_columns(sample_df)))
+    date_values = sample_df[columns['date']] if columns['date'] in sample_df.columns else []
+    return list(sample_df.columns), columns, infer_date_format(date_values), column_sample(sample_df)
+
+def column_sample(sample_df, rows=SCHEMA_SAMPLE_ROWS):
+    """
+    The first non-empty values of every column, as a list of string lists in
+    header order (JSON/BSON-safe whatever the column names are)
+    """
+    return [_clean_text(sample_df.iloc[:, pos]).head(rows).tolist() for pos in range(sample_df.shape[1])]
+
+def _clean_text(values):
+    """Non-empty values as strings, with stray quotes and whitespace removed"""
+    sample = pd.Series(values, dtype=object).dropna().astype(str).str.strip().str.strip('"').str.strip("'")
+    return sample[sample != '']
+
+def check_date_format(date_format, values=()):
+    """
+    Why a date format can't be used for a date column, or None if it can
+    It must be a valid strftime format with a date directive, and parse most
+    (see infer_date_format's min_share) of the sample values given
+    """
+    if not isinstance(date_format, str) or not any(directive in date_format for directive in DATE_DIRECTIVES):
+        return f"date_format must be a strftime format with a date directive ({' '.join(DATE_DIRECTIVES)})"
+    sample = _clean_text(values)
+    try:
+        pd.to_datetime(pd.Timestamp.now().strftime(date_format), format=date_format)
+        parsed = pd.to_datetime(sample, format=date_format, errors='coerce')
+    except (TypeError, ValueError):
+        return 'date_format must be a strftime format such as %m/%d/%Y'
+    if parsed.notna().sum() < 0.8 * len(sample):
+        return f"date_format {date_format} does not match this layout's dates (e.g. {sample.iloc[0]})"
+    return None
+
+def schema_columns(fingerprint, columns):
+    """
+    The (date, item, quantity) columns attached to a fingerprint as
+    fingerprint['columns'], or None if there are none or they don't fit this
+    header (normalized names)
+    """
+    schema = (fingerprint or {}).get('columns')
+    if not schema or not schema.get('date') or not schema.get('item'):
+        return None
+    if any(col and col not in columns for col in schema.values()):
+        return None
+    return tuple(schema.get(role) for role in SCHEMA_ROLES)
+
+def infer_date_format(values, min_share=0.8):
+    """
+    Infer the strftime format of a sample of date strings
+    Candidates are pandas' guess from the first values, then DATE_FORMATS;
+    the one parsing the most distinct values wins
+    
+    Returns:
+        Format string, or None if no format parses at least min_share of the sample
+    """
+    sample = _clean_text(values).drop_duplicates().head(DATE_SAMPLE_ROWS)
+    if sample.empty:
+        return None
+    
+    candidates = []
+    for value in sample.head(3):
+        guess = guess_datetime_format(value)
+        if guess and guess not in candidates:
+            candidates.append(guess)
+    candidates += [date_format for date_format in DATE_FORMATS if date_format not in candidates]
+    
+    best, best_count = None, 0
+    for date_format in candidates:
+        count = pd.to_datetime(sample, format=date_format, errors='coerce').notna().sum()
+        if count > best_count:
+            best, best_count = date_format, count
+            if count == len(sample):
+                break
+    return best if best_count >= min_share * len(sample) else None
+
+def parse_dates(raw, date_format=None):
+    """
+    Parse cleaned date strings
+    Everything goes through the explicit format first (vectorized). Values it
+    can't parse get a format inferred for them (exports merged from locations
+    with different settings), and only what is still left goes through
+    per-value parsing, each distinct value once - so mixed-format exports
+    keep all their rows and stay fast
+    
+    Returns:
+        datetime64 Series (NaT where unparseable)
+    """
+    if date_format:
+        parsed = pd.to_datetime(raw, format=date_format, errors='coerce')
+    else:
+        parsed = pd.Series(pd.NaT, index=raw.index, dtype='datetime64[ns]')
+    
+    candidates = raw.notna() & ~raw.isin(['', 'nan', 'None'])
+    missed = parsed.isna() & candidates
+    for _ in range(MAX_DATE_FORMATS - 1):
+        if missed.sum() < DATE_SAMPLE_ROWS:
+            break
+        other_format = infer_date_format(raw[missed], min_share=0.5)
+        if other_format is None or other_format == date_format:
+            break
+        parsed[missed] = pd.to_datetime(raw[missed], format=other_format, errors='coerce')
+        missed = parsed.isna() & candidates
+    
+    if missed.any():
+        values = raw[missed]
+        uniques = values.unique()
+        try:
+            converted = pd.to_datetime(pd.Series(uniques), format='mixed', errors='coerce')
+        except (ValueError, TypeError):
+            converted = pd.to_datetime(pd.Series(uniques), errors='coerce')  # e.g. mixed time zones
+        lookup = pd.Series(converted.values, index=uniques)
+        parsed = parsed.astype(lookup.dtype) if lookup.dtype != parsed.dtype else parsed
+        parsed[missed] = values.map(lookup)
+    return parsed
+
+def prepare_sales(df, date_col, item_col, qty_col, issues=None, date_format=None):
+    """
+    Clean the detected columns into a (date, item, quantity) frame
+    Rows with unparseable dates (including repeated header rows) are dropped;
+    missing or unreadable quantities count as 1. Both are tallied in `issues`
+    (a RowIssues) when given. Dates are parsed with date_format (inferred from
+    the first rows if not given) - see parse_dates().
+    """
+    def clean(series):
+        # Strip stray quotes from text columns; numeric columns pass through
+        if pd.api.types.is_numeric_dtype(series):
+            return series
+        return series.astype(str).str.strip().str.strip('"').str.strip("'")
+    
+    raw_dates = clean(df[date_col])
+    if date_format is None:
+        date_format = infer_date_format(raw_dates.head(DATE_SAMPLE_ROWS))
+    sales = pd.DataFrame({
+        'date': parse_dates(raw_dates, date_format),
+        'item': clean(df[item_col]).astype(str).str.strip()
+    })
+    valid = sales['date'].notna()
+    
+    # Use quantity column if available, otherwise assume 1 per row
+    if qty_col:
+        raw_qty = clean(df[qty_col])
+        quantity = pd.to_numeric(raw_qty, errors='coerce')
+        if issues is not None:
+            missing = df[qty_col].isna() | raw_qty.astype(str).eq('')
+            unreadable = quantity.isna() & ~missing & valid
+            issues.add('had no quantity - counted as 1', (missing & valid).sum())
+            issues.add('had an unreadable quantity - counted as 1', unreadable.sum(),
+                       raw_qty[unreadable].head(issues.max_samples).tolist())
+        sales['quantity'] = quantity.fillna(1).astype(float)
+    else:
+        sales['quantity'] = 1.0
+    
+    if issues is not None and not valid.all():
+        blank = df[date_col].isna() | raw_dates.astype(str).eq('')
+        issues.add('skipped: no date', (blank & ~valid).sum())
+        issues.add('skipped: unparseable date', (~blank & ~valid).sum(),
+                   raw_dates[~blank & ~valid].head(issues.max_samples).tolist())
+    
+    return sales[valid]
+
+def explode_usage(sales, mapping_table):
+    """
+    Explode sales into ingredient usage with a single join + groupby
+    
+    Returns:
+        Series of usage_oz indexed by (date, ingredient)
+    """
+    usage = pd.DataFrame({
+        'date': sales['date'].dt.normalize(),
+        'item_key': sales['item'].str.lower(),
+        'quantity': sales['quantity']
+    }).merge(mapping_table, on='item_key', how='inner')
+    usage['usage_oz'] = usage['amount'] * usage['quantity']
+    return usage.groupby(['date', 'ingredient'], sort=False)['usage_oz'].sum()
+
+def aggregate_sales(sales):
+    """
+    Sum quantities per (day, item) - the mapping-independent core of an upload
+    
+    Returns:
+        Series of quantity indexed by (date, item)
+    """
+    return sales.groupby([sales['date'].dt.normalize(), 'item'], sort=False)['quantity'].sum()
+
+def stream_daily_sales(file_path, fingerprint, chunk_size=None, progress=None):
+    """
+    Streaming ingest: read the file in fixed-size chunks with the C engine,
+    folding each chunk into running per-day/per-item totals. Peak memory
+    is bounded by the chunk size and the number of (day, item) pairs,
+    not the file size.
+    
+    Returns:
+        DataFrame with date, item, quantity columns (one row per day and item)
+    """
+    chunk_size = chunk_size or Config.CSV_CHUNK_SIZE
+    progress = progress or _no_progress
+    
+    # Use the account's stored schema, or resolve columns from the header and a handful of rows
+    raw_columns, sample_df = read_column_sample(file_path, fingerprint)
+    date_col, item_col, qty_col = schema_columns(fingerprint, sample_df.columns) or resolve_columns(sample_df)
+    date_format = fingerprint.get('date_format') or infer_date_format(sample_df[date_col])
+    
+    # Only materialize the columns we actually use
+    wanted = [col for col in (date_col, item_col, qty_col) if col]
+    positions = sorted(sample_df.columns.get_loc(col) for col in wanted)
+    names = {raw_columns[pos]: sample_df.columns[pos] for pos in positions}
+    
+    logger.info(f"Detected columns - Date: {date_col}, Item: {item_col}, "
+                f"Quantity: {qty_col if qty_col else 'N/A (using 1 per row)'}")
+    
+    totals = None
+    rows_parsed = 0
+    issues = RowIssues()
+    with open_csv(file_path, fingerprint, engine='c', dtype=str,
+                  usecols=positions, chunksize=chunk_size) as reader:
+        with reader:
+            for chunk in reader:
+                chunk = chunk.rename(columns=names)
+                daily = aggregate_sales(prepare_sales(chunk, date_col, item_col, qty_col, issues, date_format))
+                totals = daily if totals is None else totals.add(daily, fill_value=0)
+                rows_parsed += len(chunk)
+                progress('parsing', rows_parsed=rows_parsed)
+    issues.log(logger, os.path.basename(file_path))
+    
+    if totals is None:
+        return pd.DataFrame(columns=SALES_COLUMNS)
+    return totals.reset_index()
+
+def read_daily_sales(file_path, fingerprint=None, progress=None):
+    """
+    Full-file ingest using the tolerant python-engine reader
+    Used as a fallback for files the streaming C reader can't parse
+    
+    Returns:
+        DataFrame with date, item, quantity columns (one row per day and item)
+    """
+    df = detect_csv_format(file_path, fingerprint)
+    
+    if df.empty:
+        raise ValueError("CSV file is empty or could not be parsed")
+    
+    df.columns = normalize_columns(df.columns)
+    date_col, item_col, qty_col = schema_columns(fingerprint, df.columns) or resolve_columns(df)
+    logger.info(f"Detected columns - Date: {date_col}, Item: {item_col}, "
+                f"Quantity: {qty_col if qty_col else 'N/A (using 1 per row)'}")
+    
+    issues = RowIssues()
+    sales = prepare_sales(df, date_col, item_col, qty_col, issues, (fingerprint or {}).get('date_format'))
+    issues.log(logger, os.path.basename(file_path))
+    (progress or _no_progress)('parsing', rows_parsed=len(df))
+    return aggregate_sales(sales).reset_index()
+
+def _no_progress(stage, **counters):
+    """Progress callback used when nobody is listening"""
+
+def file_digest(file_path, schema=None):
+    """
+    Content hash of a file, used as its parsed-cache key
+    With a schema (dict such as {'date': col, ..., 'date_format': fmt}) the
+    key also changes when the file is read with different settings
+    """
+    digest = hashlib.sha256(PARSED_CACHE_VERSION.encode('utf-8'))
+    if schema:
+        digest.update(repr(sorted(schema.items())).encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def sales_digest(sales):
+    """Content hash of a daily sales frame (for sales that never were a file)"""
+    digest = hashlib.sha256(PARSED_CACHE_VERSION.encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(sales, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def cached_sales_path(key):
+    """Parsed cache file for a content hash"""
+    return os.path.join(Config.PARSED_CACHE_DIR, f'{key}.parquet')
+
+def load_cached_sales(key):
+    """Daily sales frame cached for a content hash, or None"""
+    if not _parquet_available():
+        return None
+    path = cached_sales_path(key)
+    try:
+        sales = pd.read_parquet(path)
+        os.utime(path)  # mark as recently used for eviction
+    except (OSError, ValueError) as e:
+        if os.path.exists(path):
+            logger.warning(f"Ignoring unreadable parsed cache entry {key}: {e}")
+        return None
+    return sales
+
+def store_cached_sales(key, sales):
+    """Write a daily sales frame to the parsed cache, then enforce its size limit"""
+    if not _parquet_available():
+        return
+    try:
+        os.makedirs(Config.PARSED_CACHE_DIR, exist_ok=True)
+        path = cached_sales_path(key)
+        # Write under a temporary name so readers never see a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        sales.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        evict_parsed_cache()
+    except OSError as e:
+        logger.warning(f"Could not write parsed cache: {e}")
+
+def evict_parsed_cache(max_bytes=None):
+    """Delete least recently used cache entries until the cache fits in max_bytes"""
+    max_bytes = Config.PARSED_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    with os.scandir(Config.PARSED_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith('.parquet'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # another worker evicted it first
+        total -= size
+
+def _parquet_available():
+    """Parquet support needs pyarrow; without it the parsed cache is disabled"""
+    global _parquet_support
+    if _parquet_support is None:
+        _parquet_support = importlib.util.find_spec('pyarrow') is not None
+        if not _parquet_support:
+            logger.warning("pyarrow not installed - parsed upload cache disabled")
+    return _parquet_support
+
+def parse_usage_file(file_path, mapping_table, fingerprint, streaming=True, chunk_size=None,
+                     progress=None, cache_key=None):
+    """
+    Aggregate one file into daily ingredient usage
+    Streams it in chunks when possible, otherwise reads the whole file.
+    With a cache_key the (date, item, quantity) frame is read from / written
+    to the parsed cache, so a repeat upload skips detection and parsing.
+    Module-level and free of app state, so it can run in a worker process.
+    A file that turns out not to be in the fingerprint's encoding is read
+    again in the next candidate encoding (see fallback_csv_format)
+    
+    Returns:
+        (usage_df with date/ingredient/usage_oz, set of item names seen, rows parsed,
+         fingerprint the file was read with)
+    """
+    rows = [0]
+    
+    def track(stage, rows_parsed=0, **counters):
+        rows[0] = rows_parsed
+        (progress or _no_progress)(stage, rows_parsed=rows_parsed, **counters)
+    
+    def read(fingerprint):
+        if streaming:
+            try:
+                return stream_daily_sales(file_path, fingerprint, chunk_size, track)
+            except pd.errors.ParserError as e:
+                logger.warning(f"Streaming ingest not possible ({e}) - reading full file")
+        return read_daily_sales(file_path, fingerprint, track)
+    
+    sales = load_cached_sales(cache_key) if cache_key else None
+    if sales is not None:
+        logger.info("Reusing parsed upload from cache")
+    else:
+        if fingerprint is None:
+            fingerprint = sniff_csv_format(file_path)
+        sales, fingerprint = with_encoding_fallback(read, file_path, fingerprint)
+        if cache_key:
+            store_cached_sales(cache_key, sales)
+    
+    all_items = set(sales['item'].unique())
+    if sales.empty:
+        return pd.DataFrame(columns=['date', 'ingredient', 'usage_oz']), all_items, rows[0], fingerprint
+    return explode_usage(sales, mapping_table).reset_index(), all_items, rows[0], fingerprint
@@ -0,0 +1,209 @@
+"""
+Lazy, self-healing MongoDB access
+Nothing touches the network until the first query, so gunicorn workers boot
+instantly. Health follows the driver's own server monitoring: while no
+writable server is reachable, callers get None and use their in-process
+fallbacks instead of waiting on timeouts, and MongoDB is used again as soon
+as the driver's background heartbeat sees it come back.
+
+The indexes every query path relies on are declared in INDEXES and built in
+the background the first time MongoDB is used (create_index is a no-op for
+indexes that already exist, so every worker can safely do this).
+"""
+import threading
+
+from pymongo import ASCENDING, DESCENDING, MongoClient, monitoring
+from pymongo.errors import ConnectionFailure, OperationFailure, PyMongoError
+
+from config import Config
+from log import get_logger
+
+logger = get_logger('database')
+
+# Hosts that mean "no real database configured" (development machines)
+LOCAL_HOSTS = ('localhost',)
+
+# Server errors for an index that exists with other options (IndexOptionsConflict, IndexKeySpecsConflict)
+INDEX_CONFLICT_CODES = (85, 86)
+
+# {collection: [(keys, options)]} - one entry per query shape
+INDEXES = {
+    # latest upload / forecast per account
+    'csv_uploads': [([('email', ASCENDING), ('processed_at', DESCENDING)], {})],
+    # latest mapping (and its version) per account
+    'ingredient_mappings': [([('email', ASCENDING), ('updated_at', DESCENDING)], {})],
+    # upsert key of account settings (forecast model, alert recipients)
+    'account_settings': [([('email', ASCENDING)], {'unique': True})],
+    # column schema per account and CSV header layout
+    'column_schemas': [([('email', ASCENDING), ('signature', ASCENDING)], {'unique': True})],
+    'alerts': [
+        # status page: an account's alerts, newest first
+        ([('email', ASCENDING), ('queued_at', DESCENDING)], {}),
+        # workers claiming due alerts and reclaiming expired leases
+        ([('status', ASCENDING), ('next_attempt_at', ASCENDING)], {}),
+        ([('status', ASCENDING), ('claimed_at', ASCENDING)], {})
+    ],
+    # upsert keys of the usage store
+    'usage_buckets': [([('email', ASCENDING), ('ingredient', ASCENDING), ('month', ASCENDING)], {'unique': True}),
+                      ([('email', ASCENDING), ('month', ASCENDING)], {})],
+    'usage_bounds': [([('email', ASCENDING), ('ingredient', ASCENDING)], {'unique': True})],
+    # finished and abandoned jobs (with their results) expire
+    'jobs': [([('updated_at', ASCENDING)], {'expireAfterSeconds': Config.UPLOAD_JOB_TTL_SECONDS})]
+}
+
+class _TopologyHealth(monitoring.TopologyListener):
+    """Tracks whether the driver currently sees a writable server"""
+    
+    def __init__(self, store):
+        self.store = store
+    
+    def opened(self, event):
+        pass
+    
+    def description_changed(self, event):
+        description = event.new_description
+        if description.has_writable_server():
+            self.store._set_healthy(True)
+        elif any(server.error is not None for server in description.server_descriptions().values()):
+            self.store._set_healthy(False)
+        # Otherwise the driver is still checking - keep the current state
+    
+    def closed(self, event):
+        pass
+
+class MongoStore:
+    """
+    MongoDB connection created on first use, with health tracking
+    
+    Args:
+        uri: MongoDB connection string ('' or a localhost URI disables MongoDB)
+        db_name: Database name
+        max_pool_size: Connections per worker process
+        min_pool_size: Connections kept open when idle
+        max_idle_ms: Close pooled connections idle for longer than this
+        connect_timeout_ms: Timeout for opening a connection
+        server_selection_timeout_ms: How long an operation waits for a usable server
+        socket_timeout_ms: Timeout for a single operation on the wire
+        heartbeat_ms: How often the driver re-checks servers (and so how soon
+            an outage or recovery is noticed)
+    """
+    
+    def __init__(self, uri, db_name, max_pool_size=10, min_pool_size=0, max_idle_ms=60000,
+                 connect_timeout_ms=5000, server_selection_timeout_ms=5000, socket_timeout_ms=60000,
+                 heartbeat_ms=10000):
+        self.uri = (uri or '').strip()
+        self.db_name = db_name
+        self.client_options = dict(
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            maxIdleTimeMS=max_idle_ms,
+            connectTimeoutMS=connect_timeout_ms,
+            serverSelectionTimeoutMS=server_selection_timeout_ms,
+            socketTimeoutMS=socket_timeout_ms,
+            heartbeatFrequencyMS=heartbeat_ms
+        )
+        self.enabled = bool(self.uri) and not any(host in self.uri for host in LOCAL_HOSTS)
+        self._client = None
+        self._healthy = None  # None until the driver has checked a server
+        self._indexes_state = None  # None, 'building' or 'ready'
+        self._lock = threading.Lock()
+    
+    @property
+    def status(self):
+        """'disabled', 'unknown' (not used yet), 'up' or 'down'"""
+        if not self.enabled:
+            return 'disabled'
+        if self._healthy is None:
+            return 'unknown'
+        return 'up' if self._healthy else 'down'
+    
+    def get_db(self):
+        """
+        The database, or None when MongoDB is disabled or currently unreachable
+        The first call creates the client; no I/O happens until a query runs
+        """
+        if not self.enabled or self._healthy is False:
+            return None
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = MongoClient(self.uri, connect=False, event_listeners=[_TopologyHealth(self)],
+                                               **self.client_options)
+        if self._indexes_state is None:
+            self._build_indexes_in_background()
+        return self._client[self.db_name]
+    
+    def collection(self, name):
+        """A collection, or None when MongoDB is disabled or currently unreachable"""
+        db = self.get_db()
+        return None if db is None else db[name]
+    
+    def collection_getter(self, name):
+        """Function returning collection(name), for components that outlive outages"""
+        return lambda: self.collection(name)
+    
+    def close(self):
+        """Close the client (a new one is created on next use)"""
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+                self._healthy = None
+                self._indexes_state = None
+    
+    def ensure_indexes(self):
+        """
+        Create any missing INDEXES (idempotent)
+        An existing index declared with other options is dropped and rebuilt;
+        an index the server rejects (e.g. existing duplicates blocking a unique
+        index) is logged and skipped; losing the connection raises
+        
+        Returns:
+            False if MongoDB is disabled or unreachable, else True
+        """
+        db = self.get_db()
+        if db is None:
+            return False
+        
+        for name, indexes in INDEXES.items():
+            for keys, options in indexes:
+                try:
+                    try:
+                        db[name].create_index(keys, **options)
+                    except OperationFailure as e:
+                        if e.code not in INDEX_CONFLICT_CODES:
+                            raise
+                        # Declared with different options (e.g. now unique) - rebuild it
+                        logger.info(f"Rebuilding index {keys} on {name} with {options}")
+                        db[name].drop_index(keys)
+                        db[name].create_index(keys, **options)
+                except ConnectionFailure:
+                    raise
+                except PyMongoError as e:
+                    logger.warning(f"Could not create index {keys} on {name}: {e}")
+        return True
+    
+    def _build_indexes_in_background(self):
+        """Run ensure_indexes() once per client on a daemon thread (retried after outages)"""
+        with self._lock:
+            if self._indexes_state is not None:
+                return
+            self._indexes_state = 'building'
+        
+        def build():
+            ready = False
+            try:
+                ready = self.ensure_indexes()
+            except Exception as e:
+                logger.warning(f"Error creating MongoDB indexes: {e}")
+            self._indexes_state = 'ready' if ready else None
+        
+        threading.Thread(target=build, name='mongo-indexes', daemon=True).start()
+    
+    def _set_healthy(self, healthy):
+        """Record the driver's view of the deployment, logging transitions"""
+        previous, self._healthy = self._healthy, healthy
+        if healthy and previous is not True:
+            logger.info("Connected to MongoDB" if previous is None else "MongoDB connection restored")
+        elif not healthy and previous is not False:
+            logger.warning("MongoDB unavailable - using in-process storage until it recovers")
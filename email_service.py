@@ -2,18 +2,174 @@
 Email service for sending low-stock alerts
 Supports both SendGrid and SMTP
 """
+import atexit
+import json
 import os
+import smtplib
+import threading
+import time
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+import urllib3
 from config import Config
+from log import get_logger
+from metrics import email_send
+
+logger = get_logger('email')
+
+SENDGRID_SEND_URL = 'https://api.sendgrid.com/v3/mail/send'
+
+# Shared SendGrid connection pool, see _get_sendgrid_client()
+_sendgrid_client = None
+_sendgrid_lock = threading.Lock()
+
+# Errors meaning the server dropped the session - safe to reconnect and resend
+SMTP_RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError)
+
+class PartialDeliveryError(Exception):
+    """
+    A send to several recipients that failed after reaching some of them
+    Retries should only go to `undelivered` so nobody gets the message twice
+    """
+    
+    def __init__(self, error, delivered, undelivered):
+        super().__init__(f"Sent to {len(delivered)} of {len(delivered) + len(undelivered)} recipients: {error}")
+        self.delivered = delivered
+        self.undelivered = undelivered
+
+class SMTPPool:
+    """
+    Thread-safe pool of authenticated SMTP sessions
+    Each session does the connect/STARTTLS/login handshake once and is reused
+    for later messages; dropped sessions are replaced transparently and idle
+    sessions are closed after idle_timeout seconds
+    
+    Args:
+        max_idle: Maximum number of idle sessions kept open
+        idle_timeout: Seconds an unused session stays open
+    """
+    
+    def __init__(self, max_idle=2, idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = []  # [(last_used, server)], most recently used last
+        self._lock = threading.Lock()
+        self._reaper = None
+    
+    def send(self, messages):
+        """
+        Send messages over one pooled session
+        If a reused session turns out to be dead it is replaced once and the
+        unsent messages are retried on the fresh session. A failure after some
+        messages went out raises PartialDeliveryError
+        """
+        pending = list(messages)
+        sent = []
+        server, reused = self._acquire()
+        while pending:
+            try:
+                server.send_message(pending[0])
+                sent.append(pending.pop(0))
+            except Exception as e:
+                _close_smtp(server)
+                if isinstance(e, SMTP_RECONNECT_ERRORS) and reused:
+                    server, reused = self._connect(), False
+                    continue
+                if sent:
+                    raise PartialDeliveryError(e, [msg['To'] for msg in sent], [msg['To'] for msg in pending]) from e
+                raise
+        self._release(server)
+    
+    def close(self):
+        """Close all idle sessions"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, server in idle:
+            _close_smtp(server)
+    
+    def _connect(self):
+        """Open a new authenticated TLS session"""
+        server = smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT, timeout=Config.SMTP_TIMEOUT)
+        try:
+            server.starttls()
+            server.login(Config.SMTP_USERNAME, Config.SMTP_PASSWORD)
+        except Exception:
+            _close_smtp(server)
+            raise
+        return server
+    
+    def _acquire(self):
+        """Take the most recently used live session, or open a new one"""
+        expired = []
+        session = None
+        with self._lock:
+            while self._idle:
+                last_used, server = self._idle.pop()
+                if time.monotonic() - last_used < self.idle_timeout:
+                    session = server
+                    break
+                expired.append(server)
+        
+        # QUIT is network I/O - never hold the lock for it
+        for server in expired:
+            _close_smtp(server)
+        if session is not None:
+            return session, True
+        return self._connect(), False
+    
+    def _release(self, server):
+        """Return a session to the pool, or close it if the pool is full"""
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((time.monotonic(), server))
+                if self._reaper is None:
+                    self._reaper = threading.Thread(target=self._reap, name='smtp-reaper', daemon=True)
+                    self._reaper.start()
+                return
+        _close_smtp(server)
+    
+    def _reap(self):
+        """Close sessions that sat idle too long; exits once the pool is empty"""
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            with self._lock:
+                expired = [server for last_used, server in self._idle if now - last_used >= self.idle_timeout]
+                self._idle = [(last_used, server) for last_used, server in self._idle
+                              if now - last_used < self.idle_timeout]
+                done = not self._idle
+                if done:
+                    self._reaper = None
+            for server in expired:
+                _close_smtp(server)
+            if done:
+                return
+
+def _close_smtp(server):
+    """Quit an SMTP session, ignoring errors from an already dead connection"""
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+_smtp_pool = SMTPPool(max_idle=Config.SMTP_POOL_SIZE, idle_timeout=Config.SMTP_IDLE_TIMEOUT)
+atexit.register(_smtp_pool.close)
 
 def send_low_stock_alert(to_email, ingredient, days_remaining, daily_usage):
     """
     Send low-stock alert email
     
     Args:
-        to_email: Recipient email address
+        to_email: Recipient address or list of addresses
         ingredient: Name of ingredient (e.g., 'milk')
         days_remaining: Projected days until stock runs out
         daily_usage: Average daily usage in ounces
+    
+    Returns:
+        Transport used: 'sendgrid', 'smtp' or 'console'
     """
     # Clean subject line without special characters (better deliverability)
     subject = f"Low Stock Alert - {ingredient.capitalize()} - {days_remaining:.1f} days remaining"
@@ -36,7 +192,70 @@ StockWise Inventory Management System
 """
     
     # HTML version (better deliverability)
-    html_message = f"""<!DOCTYPE html>
+    html_message = _render_html("Low Stock Alert", f"""<h3 style="margin-top: 0; color: #0052CC;">Inventory Status Update</h3>
+            <p style="margin-bottom: 5px;"><strong>Ingredient:</strong> {ingredient.capitalize()}</p>
+            <p style="margin-bottom: 5px;"><strong>Projected days remaining:</strong> approximately {days_remaining:.1f} days</p>
+            <p style="margin-bottom: 0;"><strong>Average daily usage:</strong> {daily_usage:.2f} oz</p>""")
+    
+    return _dispatch(to_email, subject, plain_message, html_message)
+
+def send_low_stock_digest(to_emails, items):
+    """
+    Send one digest email covering every low-stock ingredient
+    
+    Args:
+        to_emails: Recipient address or list of addresses (same account)
+        items: List of dicts with ingredient, days_remaining, daily_usage
+    
+    Returns:
+        Transport used: 'sendgrid', 'smtp' or 'console'
+    """
+    items = sorted(items, key=lambda item: item['days_remaining'])
+    count = len(items)
+    subject = f"Low Stock Alert - {count} ingredient{'s' if count != 1 else ''} running low"
+    
+    lines = '\n'.join(
+        f"- {item['ingredient'].capitalize()}: approximately {item['days_remaining']:.1f} days remaining "
+        f"({item['daily_usage']:.2f} oz/day)"
+        for item in items
+    )
+    plain_message = f"""Hello,
+
+This is an automated notification from StockWise.
+
+Inventory Update
+
+{lines}
+
+Please consider restocking soon.
+
+---
+StockWise Inventory Management System
+"""
+    
+    rows = ''.join(
+        f"""
+                <tr>
+                    <td style="padding: 6px 0;">{item['ingredient'].capitalize()}</td>
+                    <td style="padding: 6px 0; text-align: right;">{item['days_remaining']:.1f} days</td>
+                    <td style="padding: 6px 0; text-align: right;">{item['daily_usage']:.2f} oz/day</td>
+                </tr>"""
+        for item in items
+    )
+    html_message = _render_html("Low Stock Alert", f"""<h3 style="margin-top: 0; color: #0052CC;">Inventory Status Update</h3>
+            <table style="width: 100%; border-collapse: collapse;">
+                <tr>
+                    <th style="text-align: left;">Ingredient</th>
+                    <th style="text-align: right;">Days remaining</th>
+                    <th style="text-align: right;">Average usage</th>
+                </tr>{rows}
+            </table>""")
+    
+    return _dispatch(to_emails, subject, plain_message, html_message)
+
+def _render_html(title, status_html):
+    """Wrap the inventory status block in the standard alert email layout"""
+    return f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
@@ -44,17 +263,14 @@ StockWise Inventory Management System
 </head>
 <body style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px;">
     <div style="background: #fff; border-radius: 8px; padding: 30px; border: 1px solid #e0e0e0;">
-        <h2 style="color: #dc3545; margin-top: 0; font-size: 24px;">Low Stock Alert</h2>
+        <h2 style="color: #dc3545; margin-top: 0; font-size: 24px;">{title}</h2>
         
         <p>Hello,</p>
         
         <p>This is an automated alert from <strong>StockWise</strong>.</p>
         
         <div style="background: #e7f3ff; border-left: 4px solid #0052CC; padding: 15px; margin: 20px 0; border-radius: 4px;">
-            <h3 style="margin-top: 0; color: #0052CC;">Inventory Status Update</h3>
-            <p style="margin-bottom: 5px;"><strong>Ingredient:</strong> {ingredient.capitalize()}</p>
-            <p style="margin-bottom: 5px;"><strong>Projected days remaining:</strong> approximately {days_remaining:.1f} days</p>
-            <p style="margin-bottom: 0;"><strong>Average daily usage:</strong> {daily_usage:.2f} oz</p>
+            {status_html}
         </div>
         
         <p>Please consider restocking soon to maintain inventory levels.</p>
@@ -72,189 +288,153 @@ StockWise Inventory Management System
     </div>
 </body>
 </html>"""
+
+def _dispatch(to_email, subject, plain_message, html_message):
+    """
+    Send a message with the first configured transport
+    to_email may be a single address or a list of addresses
+    
+    Returns:
+        Transport used: 'sendgrid', 'smtp' or 'console' (only when no
+        transport is configured)
+    Raises if the configured transport fails, so the alert queue retries it
+    """
+    recipients = to_email if isinstance(to_email, str) else ', '.join(to_email)
     
     # Try SendGrid first if API key is configured
     if Config.SENDGRID_API_KEY and Config.SENDGRID_API_KEY.strip():
         try:
-            send_via_sendgrid(to_email, subject, plain_message, html_message)
-            print(f"✓ Alert sent via SendGrid to {to_email}")
-            return
+            with email_send('sendgrid'):
+                send_via_sendgrid(to_email, subject, plain_message, html_message)
+            logger.info(f"Alert sent via SendGrid to {recipients}")
+            return 'sendgrid'
         except Exception as e:
             error_msg = str(e)
-            print(f"⚠ SendGrid failed: {error_msg}")
+            logger.warning(f"SendGrid failed: {error_msg}")
             # Don't try SMTP if SendGrid is configured but failed - show the error
             if "sender" in error_msg.lower() or "from" in error_msg.lower() or "verify" in error_msg.lower():
-                print(f"\n⚠️ IMPORTANT: You may need to verify your sender email in SendGrid:")
-                print(f"   1. Go to: https://app.sendgrid.com/settings/sender_auth")
-                print(f"   2. Verify: {Config.ALERT_EMAIL_FROM}")
-                print(f"   3. Or use Single Sender Verification\n")
+                logger.warning(
+                    f"You may need to verify your sender email in SendGrid: go to "
+                    f"https://app.sendgrid.com/settings/sender_auth and verify {Config.ALERT_EMAIL_FROM} "
+                    f"(or use Single Sender Verification)"
+                )
             raise  # Re-raise so the error is shown in the UI
     
     # Fallback to SMTP
     if Config.SMTP_USERNAME and Config.SMTP_PASSWORD and Config.SMTP_USERNAME.strip() and Config.SMTP_PASSWORD.strip():
         try:
-            send_via_smtp(to_email, subject, plain_message, html_message)
-            print(f"✓ Alert sent via SMTP to {to_email}")
-            return
+            with email_send('smtp'):
+                send_via_smtp(to_email, subject, plain_message, html_message)
+            logger.info(f"Alert sent via SMTP to {recipients}")
+            return 'smtp'
         except Exception as e:
-            print(f"⚠ SMTP failed: {e}")
+            logger.warning(f"SMTP failed: {e}")
+            raise
     
-    # If both fail, print to console (for development/testing)
-    print("\n" + "="*50)
-    print("EMAIL ALERT (Console Output - Email not configured)")
-    print("="*50)
-    print(f"To: {to_email}")
-    print(f"Subject: {subject}")
-    print(f"Message:\n{plain_message}")
-    print("="*50 + "\n")
+    # No transport configured - print to console (for development/testing)
+    logger.info(
+        f"EMAIL ALERT (Console Output - Email not configured)\n"
+        f"To: {recipients}\nSubject: {subject}\nMessage:\n{plain_message}"
+    )
+    return 'console'
 
 def send_via_sendgrid(to_email, subject, plain_message, html_message=None):
-    """Send email using SendGrid API"""
-    # Fix SSL certificate issues
-    import ssl
-    import urllib3
-    import warnings
+    """
+    Send email using the SendGrid v3 API over a shared keep-alive connection
+    A list of recipients goes out in one request, one personalization each
+    """
+    try:
+        from sendgrid.helpers.mail import Mail
+    except ImportError:
+        raise Exception("SendGrid package not installed. Run: pip install sendgrid")
     
-    # Disable SSL verification warnings
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-    warnings.filterwarnings('ignore', message='Unverified HTTPS request')
+    # Create email with both plain text and HTML for better deliverability
+    message_obj = Mail(
+        from_email=Config.ALERT_EMAIL_FROM,
+        to_emails=to_email,
+        subject=subject,
+        plain_text_content=plain_message,
+        html_content=html_message if html_message else None,
+        is_multiple=not isinstance(to_email, str)
+    )
     
-    # Set unverified SSL context globally (for testing - not recommended for production)
-    try:
-        ssl._create_default_https_context = ssl._create_unverified_context
-    except:
-        pass
+    # Add better headers to avoid spam
+    if Config.ALERT_EMAIL_FROM:
+        message_obj.reply_to = Config.ALERT_EMAIL_FROM
     
     try:
-        from sendgrid import SendGridAPIClient
-        from sendgrid.helpers.mail import Mail
-        
-        # Create email with both plain text and HTML for better deliverability
-        message_obj = Mail(
-            from_email=Config.ALERT_EMAIL_FROM,
-            to_emails=to_email,
-            subject=subject,
-            plain_text_content=plain_message,
-            html_content=html_message if html_message else None
+        # Connection errors, 429 and 5xx are retried with backoff by the pool
+        response = _get_sendgrid_client().request(
+            'POST', SENDGRID_SEND_URL, body=json.dumps(message_obj.get()).encode('utf-8')
         )
-        
-        # Add better headers to avoid spam
-        if Config.ALERT_EMAIL_FROM:
-            message_obj.reply_to = Config.ALERT_EMAIL_FROM
-        
-        sg = SendGridAPIClient(Config.SENDGRID_API_KEY)
-        response = sg.send(message_obj)
-        
-        if response.status_code not in [200, 201, 202]:
-            # Get error details from response body
-            error_body = ""
-            try:
-                error_body = response.body.decode('utf-8')
-            except:
-                pass
-            raise Exception(f"SendGrid API returned status {response.status_code}: {error_body}")
-            
-    except ImportError as ie:
-        if "certifi" in str(ie):
-            # Try without certifi
-            try:
-                from sendgrid import SendGridAPIClient
-                from sendgrid.helpers.mail import Mail
-                import ssl
-                import urllib3
-                urllib3.disable_warnings()
-                
-                message_obj = Mail(
-                    from_email=Config.ALERT_EMAIL_FROM,
-                    to_emails=to_email,
-                    subject=subject,
-                    plain_text_content=message
-                )
-                
-                sg = SendGridAPIClient(Config.SENDGRID_API_KEY)
-                response = sg.send(message_obj)
-                
-                if response.status_code not in [200, 201, 202]:
-                    error_body = ""
-                    try:
-                        error_body = response.body.decode('utf-8')
-                    except:
-                        pass
-                    raise Exception(f"SendGrid API returned status {response.status_code}: {error_body}")
-            except Exception as e2:
-                raise Exception(f"SendGrid error (no certifi): {str(e2)}")
-        else:
-            raise Exception("SendGrid package not installed. Run: pip install sendgrid")
-    except Exception as e:
-        # Re-raise with more context
-        error_msg = str(e)
-        if "SSL" in error_msg or "CERTIFICATE" in error_msg or "certificate" in error_msg:
-            # Try with unverified SSL context
-            try:
-                import ssl
-                import urllib3
-                urllib3.disable_warnings()
-                
-                from sendgrid import SendGridAPIClient
-                from sendgrid.helpers.mail import Mail
-                
-                message_obj = Mail(
-                    from_email=Config.ALERT_EMAIL_FROM,
-                    to_emails=to_email,
-                    subject=subject,
-                    plain_text_content=message
-                )
-                
-                # Disable SSL verification warnings
-                import warnings
-                warnings.filterwarnings('ignore', message='Unverified HTTPS request')
-                
-                sg = SendGridAPIClient(Config.SENDGRID_API_KEY)
-                response = sg.send(message_obj)
-                
-                if response.status_code not in [200, 201, 202]:
-                    error_body = ""
-                    try:
-                        error_body = response.body.decode('utf-8')
-                    except:
-                        pass
-                    raise Exception(f"SendGrid API returned status {response.status_code}: {error_body}")
-                
-                print("⚠ Email sent with SSL verification disabled (testing mode)")
-                return  # Success!
-            except Exception as e2:
-                raise Exception(f"SendGrid SSL error (retry failed): {str(e2)}")
-        elif "401" in error_msg or "Unauthorized" in error_msg:
-            raise Exception(f"SendGrid authentication failed. Check your API key. Error: {error_msg}")
-        elif "403" in error_msg or "Forbidden" in error_msg:
-            raise Exception(f"SendGrid permission denied. Check API key permissions. Error: {error_msg}")
-        elif "sender" in error_msg.lower() or "from" in error_msg.lower():
+    except urllib3.exceptions.HTTPError as e:
+        raise Exception(f"SendGrid error: {str(e)}")
+    
+    if response.status in (200, 201, 202):
+        return
+    
+    # Get error details from response body
+    error_msg = f"SendGrid API returned status {response.status}: {response.data.decode('utf-8', 'replace')}"
+    if response.status == 401:
+        raise Exception(f"SendGrid authentication failed. Check your API key. Error: {error_msg}")
+    elif response.status == 403:
+        if "sender" in error_msg.lower() or "from" in error_msg.lower():
             raise Exception(f"SendGrid sender email issue. Verify '{Config.ALERT_EMAIL_FROM}' in SendGrid dashboard. Error: {error_msg}")
-        else:
-            raise Exception(f"SendGrid error: {error_msg}")
+        raise Exception(f"SendGrid permission denied. Check API key permissions. Error: {error_msg}")
+    else:
+        raise Exception(f"SendGrid error: {error_msg}")
+
+def _get_sendgrid_client():
+    """
+    Shared HTTP connection pool for the SendGrid API, built on first use
+    The pool keeps TLS connections alive between sends and is thread-safe
+    """
+    global _sendgrid_client
+    if _sendgrid_client is None:
+        with _sendgrid_lock:
+            if _sendgrid_client is None:
+                _sendgrid_client = urllib3.PoolManager(
+                    num_pools=1,
+                    maxsize=Config.SENDGRID_POOL_SIZE,
+                    headers={
+                        'Authorization': f'Bearer {Config.SENDGRID_API_KEY}',
+                        'Content-Type': 'application/json'
+                    },
+                    timeout=urllib3.Timeout(connect=5, read=Config.SENDGRID_TIMEOUT),
+                    retries=urllib3.Retry(
+                        total=Config.SENDGRID_RETRIES,
+                        read=0,  # the request may have been accepted - don't risk a duplicate email
+                        backoff_factor=0.5,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=None,  # POST is safe to retry on connect errors and retryable statuses
+                        raise_on_status=False
+                    )
+                )
+    return _sendgrid_client
 
 def send_via_smtp(to_email, subject, plain_message, html_message=None):
-    """Send email using SMTP"""
-    import smtplib
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
-    
-    msg = MIMEMultipart('alternative')
-    msg['From'] = Config.ALERT_EMAIL_FROM
-    msg['To'] = to_email
-    msg['Subject'] = subject
-    msg['Reply-To'] = Config.ALERT_EMAIL_FROM
-    
-    # Add both plain text and HTML versions
-    part1 = MIMEText(plain_message, 'plain')
-    msg.attach(part1)
+    """
+    Send email using SMTP over a pooled, already authenticated session
+    A list of recipients is sent over a single session, one message each
+    """
+    recipients = [to_email] if isinstance(to_email, str) else list(to_email)
     
-    if html_message:
-        part2 = MIMEText(html_message, 'html')
-        msg.attach(part2)
+    messages = []
+    for recipient in recipients:
+        msg = MIMEMultipart('alternative')
+        msg['From'] = Config.ALERT_EMAIL_FROM
+        msg['To'] = recipient
+        msg['Subject'] = subject
+        msg['Reply-To'] = Config.ALERT_EMAIL_FROM
+        
+        # Add both plain text and HTML versions
+        part1 = MIMEText(plain_message, 'plain')
+        msg.attach(part1)
+        
+        if html_message:
+            part2 = MIMEText(html_message, 'html')
+            msg.attach(part2)
+        
+        messages.append(msg)
     
-    server = smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT)
-    server.starttls()
-    server.login(Config.SMTP_USERNAME, Config.SMTP_PASSWORD)
-    server.send_message(msg)
-    server.quit()
+    _smtp_pool.send(messages)
@@ -0,0 +1,241 @@
+"""
+Forecasting engine
+Every model works on one (date x ingredient) matrix of daily usage and
+projects all ingredients at once; days remaining come from walking each
+ingredient's projected usage down from its current stock
+"""
+import numpy as np
+
+# Stock assumed for ingredients without a stock level (oz)
+DEFAULT_STOCK_OZ = 1000
+
+def build_daily_matrix(usage_df):
+    """
+    Pivot daily usage into a (date x ingredient) matrix
+    Days between an ingredient's first and last usage count as zero usage;
+    days outside that range are NaN. Ingredients keep their order of first
+    appearance.
+    
+    Returns:
+        (daily DataFrame, in_range boolean DataFrame of the same shape)
+    """
+    ingredients = usage_df['ingredient'].unique()
+    
+    daily = usage_df.groupby(['date', 'ingredient'])['usage_oz'].sum().unstack()
+    daily = daily.reindex(columns=ingredients).resample('D').sum(min_count=1)
+    
+    observed = daily.notna()
+    in_range = observed.cumsum().gt(0) & observed[::-1].cumsum()[::-1].gt(0)
+    return daily.mask(in_range & ~observed, 0), in_range
+
+def trailing_window(daily, in_range, days):
+    """
+    Each ingredient's last `days` days, ending at its own last usage day
+    
+    Returns:
+        (values: days x ingredients array, oldest first, NaN before an
+        ingredient's first usage; last: row index of each ingredient's last day)
+    """
+    values = daily.to_numpy(dtype=float)
+    mask = in_range.to_numpy()
+    last = len(values) - 1 - np.argmax(mask[::-1], axis=0)
+    
+    rows = last[None, :] - np.arange(days - 1, -1, -1)[:, None]
+    cols = np.broadcast_to(np.arange(values.shape[1]), rows.shape)
+    window = values[np.clip(rows, 0, None), cols]
+    window[rows < 0] = np.nan
+    return window, last
+
+def _nanmean(values, axis=0):
+    """Mean ignoring NaN, NaN where there are no values (without warnings)"""
+    present = ~np.isnan(values)
+    counts = present.sum(axis=axis)
+    totals = np.where(present, values, 0).sum(axis=axis)
+    return np.divide(totals, counts, out=np.full(totals.shape, np.nan), where=counts > 0)
+
+class ForecastModel:
+    """
+    Base class for forecasting models
+    
+    Subclasses implement project(); models whose projection is flat set
+    constant_rate so days remaining is simply stock / rate
+    
+    Args:
+        window: Days of history the model looks at
+    """
+    name = None
+    description = ''
+    constant_rate = False
+    
+    def __init__(self, window=7):
+        self.window = window
+    
+    @property
+    def history_days(self):
+        """Days of trailing history needed per ingredient"""
+        return self.window
+    
+    def project(self, daily, in_range, horizon):
+        """
+        Projected daily usage for the `horizon` days after each ingredient's
+        last usage day
+        
+        Returns:
+            (horizon x ingredients) array
+        """
+        raise NotImplementedError
+
+class RollingMeanModel(ForecastModel):
+    """Flat projection of the trailing rolling mean (the original forecast)"""
+    name = 'rolling_mean'
+    description = 'Average daily usage over the last week'
+    constant_rate = True
+    
+    def project(self, daily, in_range, horizon):
+        rolling = daily.rolling(window=self.window, min_periods=1).mean()
+        rolling_avg = rolling.where(in_range).ffill().iloc[-1].to_numpy()
+        return np.broadcast_to(rolling_avg, (horizon, len(rolling_avg)))
+
+class EWMAModel(ForecastModel):
+    """Flat projection of an exponentially weighted moving average"""
+    name = 'ewma'
+    description = 'Exponentially weighted average - reacts faster to recent changes'
+    constant_rate = True
+    
+    @property
+    def history_days(self):
+        # Older days carry less than 0.1% of the weight
+        return self.window * 4
+    
+    def project(self, daily, in_range, horizon):
+        smoothed = daily.ewm(span=self.window, adjust=False, ignore_na=True).mean()
+        level = smoothed.where(in_range).ffill().iloc[-1].to_numpy()
+        return np.broadcast_to(level, (horizon, len(level)))
+
+class DayOfWeekModel(ForecastModel):
+    """Seasonal projection: each future day uses that weekday's recent average"""
+    name = 'day_of_week'
+    description = 'Average usage per weekday over the last four weeks'
+    
+    @property
+    def history_days(self):
+        return max(self.window, 7) * 4
+    
+    def project(self, daily, in_range, horizon):
+        values, last = trailing_window(daily, in_range, self.history_days)
+        last_weekday = daily.index[last].dayofweek.to_numpy()
+        
+        # Weekday of every window row, per ingredient
+        offsets = np.arange(self.history_days - 1, -1, -1)[:, None]
+        weekday = (last_weekday[None, :] - offsets) % 7
+        
+        profile = np.stack([_nanmean(np.where(weekday == day, values, np.nan)) for day in range(7)])
+        profile = np.where(np.isnan(profile), _nanmean(values), profile)
+        
+        future_weekday = (last_weekday[None, :] + 1 + np.arange(horizon)[:, None]) % 7
+        return np.take_along_axis(profile, future_weekday, axis=0)
+
+class LinearTrendModel(ForecastModel):
+    """Least-squares linear trend over recent usage, floored at zero"""
+    name = 'linear_trend'
+    description = 'Linear trend over the last four weeks - for growing or shrinking usage'
+    
+    @property
+    def history_days(self):
+        return max(self.window, 7) * 4
+    
+    def project(self, daily, in_range, horizon):
+        values, _ = trailing_window(daily, in_range, self.history_days)
+        present = ~np.isnan(values)
+        y = np.where(present, values, 0)
+        
+        # x = 0 is each ingredient's last usage day
+        x = np.broadcast_to(np.arange(1 - self.history_days, 1, dtype=float)[:, None], values.shape)
+        counts = present.sum(axis=0)
+        x_mean = np.where(present, x, 0).sum(axis=0) / counts
+        y_mean = y.sum(axis=0) / counts
+        dx = np.where(present, x - x_mean, 0)
+        sxx = (dx * dx).sum(axis=0)
+        slope = np.divide((dx * (y - y_mean)).sum(axis=0), sxx, out=np.zeros_like(sxx), where=sxx > 0)
+        level = y_mean - slope * x_mean
+        
+        steps = np.arange(1, horizon + 1, dtype=float)[:, None]
+        return np.clip(level + slope * steps, 0, None)
+
+MODELS = {model.name: model for model in (RollingMeanModel, EWMAModel, DayOfWeekModel, LinearTrendModel)}
+
+def get_model(name=None, window=7):
+    """Instantiate a forecasting model by name (defaults to rolling_mean)"""
+    if name and name not in MODELS:
+        raise ValueError(f"Unknown forecast model '{name}'. Choose from: {', '.join(MODELS)}")
+    return MODELS[name or RollingMeanModel.name](window=window)
+
+def days_until_empty(projection, stock):
+    """
+    Days until cumulative projected usage reaches the stock, per ingredient
+    Interpolates within the day stock runs out; beyond the horizon the last
+    projected week's average rate is assumed
+    
+    Args:
+        projection: (horizon x ingredients) projected daily usage
+        stock: Stock per ingredient
+    """
+    horizon = len(projection)
+    cumulative = projection.cumsum(axis=0)
+    runs_out = cumulative >= stock
+    found = runs_out.any(axis=0)
+    day = np.argmax(runs_out, axis=0)
+    
+    cols = np.arange(projection.shape[1])
+    before = np.where(day > 0, cumulative[np.maximum(day - 1, 0), cols], 0)
+    usage_that_day = projection[day, cols]
+    within = day + np.divide(stock - before, usage_that_day,
+                             out=np.zeros_like(before), where=usage_that_day > 0)
+    
+    tail_rate = projection[-7:].mean(axis=0)
+    beyond = horizon + np.divide(stock - cumulative[-1], tail_rate,
+                                 out=np.full(tail_rate.shape, np.inf), where=tail_rate > 0)
+    return np.where(found, within, beyond)
+
+def compute_forecast(usage_df, stock_levels, window=7, model=None, horizon=90):
+    """
+    Forecast days remaining for every ingredient at once
+    
+    Args:
+        usage_df: DataFrame with date, ingredient, usage_oz columns
+        stock_levels: Dict of {ingredient: stock_amount_in_oz}, defaults to 1000oz
+        window: History window of the model (days)
+        model: Forecast model name or ForecastModel (defaults to rolling_mean)
+        horizon: Days projected before extrapolating at a flat rate
+    
+    Returns:
+        Dict of {ingredient: {daily_avg_usage_oz, days_remaining, current_stock_oz}}
+    """
+    if not isinstance(model, ForecastModel):
+        model = get_model(model, window)
+    if usage_df.empty:
+        return {}
+    
+    daily, in_range = build_daily_matrix(usage_df)
+    ingredients = daily.columns
+    projection = model.project(daily, in_range, horizon)
+    stock = np.array([stock_levels.get(ingredient, DEFAULT_STOCK_OZ) for ingredient in ingredients], dtype=float)
+    
+    if model.constant_rate:
+        # Flat projection - days remaining is exactly stock / rate
+        rates = projection[0]
+        days = np.divide(stock, rates, out=np.full(stock.shape, np.inf), where=rates > 0)
+    else:
+        # Reported usage is the average over the coming week
+        rates = projection[:7].mean(axis=0)
+        days = days_until_empty(projection, stock)
+    
+    forecast_results = {}
+    for i, ingredient in enumerate(ingredients):
+        forecast_results[ingredient] = {
+            'daily_avg_usage_oz': round(rates[i], 2),
+            'days_remaining': round(days[i], 2),
+            'current_stock_oz': stock_levels.get(ingredient, DEFAULT_STOCK_OZ)
+        }
+    
+    return forecast_results
@@ -0,0 +1,22 @@
+"""
+Gunicorn settings (loaded automatically from the working directory)
+Workers share their Prometheus metrics through PROMETHEUS_MULTIPROC_DIR so
+/metrics reports the whole service, whichever worker serves it
+"""
+import os
+import shutil
+import tempfile
+
+# Must be set before prometheus_client is imported anywhere
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'stockwise-metrics'))
+
+def on_starting(server):
+    """Start from empty metrics on every deploy/restart"""
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    """Drop a dead worker's live-only samples"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,229 @@
+"""
+Background processing jobs
+Uploads are processed on a small local worker pool instead of inside the
+request; the job document records the current stage, progress counters and
+finally the result (or error), so any gunicorn worker can report on it
+
+With MongoDB jobs are documents in the jobs collection whose status moves
+queued -> running -> done / failed. Without MongoDB (or while it is
+unreachable) they are kept in process. Running jobs refresh updated_at on a
+heartbeat; a job whose lease runs out (its worker died, or MongoDB went away
+mid-job) is reported as failed.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo.errors import PyMongoError
+
+from log import correlation, get_correlation_id, get_logger
+from metrics import mongo_write
+
+logger = get_logger('jobs')
+
+# Statuses after which a job never changes again
+FINAL_STATUSES = ('done', 'failed')
+
+class JobRunner:
+    """
+    Local worker pool that runs jobs and records their progress
+    
+    Args:
+        get_collection: Function returning the MongoDB jobs collection, or None
+            while MongoDB is unavailable (omit for in-process storage only)
+        workers: Number of worker threads
+        max_local_jobs: Jobs remembered without MongoDB (oldest finished dropped first)
+        heartbeat: Seconds between updated_at refreshes of running jobs
+        lease: Seconds without an update after which an unfinished job is failed
+    """
+    
+    def __init__(self, get_collection=None, workers=2, max_local_jobs=200, heartbeat=15, lease=120):
+        self.get_collection = get_collection or (lambda: None)
+        self.max_local_jobs = max_local_jobs
+        self.heartbeat = heartbeat
+        self.lease = lease
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job-worker')
+        self._local = OrderedDict()  # job_id -> doc, used without MongoDB
+        self._local_lock = threading.Lock()
+        self._running = set()  # ids of jobs queued or running in this process
+        self._heartbeat_thread = None
+    
+    def submit(self, kind, email, func, *args, **kwargs):
+        """
+        Queue func(*args, progress=callback, **kwargs) on the worker pool
+        The callback takes (stage, **counters); func's return value is stored
+        as the job result
+        
+        Returns:
+            Job id (string) that can be used to poll progress
+        """
+        now = datetime.utcnow()
+        job_id = uuid.uuid4().hex
+        job = {
+            '_id': job_id,
+            'kind': kind,
+            'email': email,
+            'status': 'queued',
+            'stage': 'queued',
+            'progress': {},
+            'result': None,
+            'error': None,
+            'correlation_id': get_correlation_id() or job_id,  # the submitting request's, for log lookups
+            'created_at': now,
+            'updated_at': now
+        }
+        
+        collection = self.get_collection()
+        if collection is not None:
+            try:
+                with mongo_write('job_insert'):
+                    collection.insert_one(job)
+            except PyMongoError as e:
+                logger.warning(f"Could not store job in MongoDB ({e}) - keeping it in process")
+                collection = None
+        
+        if collection is None:
+            with self._local_lock:
+                self._local[job_id] = job
+                self._trim_local()
+        
+        with self._local_lock:
+            self._running.add(job_id)
+        self._start_heartbeat()
+        self._executor.submit(self._run, job_id, job['correlation_id'], func, args, kwargs)
+        return job_id
+    
+    def get(self, job_id, include_result=True):
+        """
+        Get a job document, or None if unknown
+        An unfinished job whose lease has run out is returned as failed
+        """
+        with self._local_lock:
+            job = self._local.get(job_id)
+            job = dict(job, progress=dict(job['progress'])) if job else None
+        
+        collection = self.get_collection() if job is None else None
+        if collection is not None:
+            projection = None if include_result else {'result': 0}
+            job = collection.find_one({'_id': job_id}, projection)
+        
+        if job is not None and not include_result:
+            job.pop('result', None)
+        if (job is not None and job['status'] not in FINAL_STATUSES
+                and job['updated_at'] < datetime.utcnow() - timedelta(seconds=self.lease)):
+            job.update(status='failed', stage='failed',
+                       error='Processing stopped unexpectedly - please upload the file again')
+        return job
+    
+    def _run(self, job_id, correlation_id, func, args, kwargs):
+        """Worker: run one job and record its outcome"""
+        try:
+            with correlation(correlation_id):
+                self._run_job(job_id, func, args, kwargs)
+        finally:
+            with self._local_lock:
+                self._running.discard(job_id)
+    
+    def _run_job(self, job_id, func, args, kwargs):
+        """Run one job, logging under its correlation id"""
+        warned = []
+        
+        def progress(stage, **counters):
+            # Best effort: a missed progress update must not fail the job
+            fields = {'stage': stage}
+            fields.update({f'progress.{name}': value for name, value in counters.items()})
+            try:
+                self._update(job_id, fields)
+            except Exception as e:
+                if not warned:
+                    logger.warning(f"Could not record progress of job {job_id}: {e}")
+                    warned.append(True)
+        
+        self._update(job_id, {'status': 'running', 'stage': 'starting'}, best_effort=True)
+        try:
+            result = func(*args, progress=progress, **kwargs)
+        except Exception as e:
+            logger.warning(f"Job {job_id} failed: {e}")
+            self._update(job_id, {'status': 'failed', 'stage': 'failed', 'error': str(e)}, best_effort=True)
+            return
+        
+        try:
+            self._update(job_id, {'status': 'done', 'stage': 'done', 'result': result})
+        except Exception as e:
+            logger.warning(f"Error storing result of job {job_id}: {e}")
+            # If this fails too the job's lease runs out and it is reported as failed
+            self._update(job_id, {'status': 'failed', 'stage': 'failed',
+                                  'error': f'Could not store job result: {e}'}, best_effort=True)
+    
+    def _update(self, job_id, fields, best_effort=False):
+        """
+        Set fields on a job ('progress.<name>' keys update single counters)
+        With best_effort a failed MongoDB write is logged instead of raised
+        """
+        try:
+            self._write(job_id, fields)
+        except Exception as e:
+            if not best_effort:
+                raise
+            logger.warning(f"Could not update job {job_id}: {e}")
+    
+    def _write(self, job_id, fields):
+        """Apply an update to the in-process job or the job document"""
+        fields['updated_at'] = datetime.utcnow()
+        
+        with self._local_lock:
+            job = self._local.get(job_id)
+            if job is not None:
+                for key, value in fields.items():
+                    if key.startswith('progress.'):
+                        job['progress'][key[len('progress.'):]] = value
+                    else:
+                        job[key] = value
+                return
+        
+        collection = self.get_collection()
+        if collection is None:
+            raise RuntimeError('MongoDB unavailable')
+        with mongo_write('job_update'):
+            collection.update_one({'_id': job_id}, {'$set': fields})
+    
+    def _trim_local(self):
+        """Forget the oldest finished jobs so in-process storage stays bounded"""
+        if len(self._local) <= self.max_local_jobs:
+            return
+        for job_id in [job_id for job_id, job in self._local.items() if job['status'] in FINAL_STATUSES]:
+            del self._local[job_id]
+            if len(self._local) <= self.max_local_jobs:
+                break
+    
+    def _start_heartbeat(self):
+        """Start the thread refreshing running jobs' leases (idempotent)"""
+        with self._local_lock:
+            if self._heartbeat_thread is not None and self._heartbeat_thread.is_alive():
+                return
+            self._heartbeat_thread = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+            self._heartbeat_thread.start()
+    
+    def _beat(self):
+        """Heartbeat loop: bump updated_at of this process's running MongoDB jobs"""
+        while True:
+            time.sleep(self.heartbeat)
+            with self._local_lock:
+                job_ids = [job_id for job_id in self._running if job_id not in self._local]
+                now = datetime.utcnow()
+                for job_id in self._running:
+                    if job_id in self._local:
+                        self._local[job_id]['updated_at'] = now
+            if not job_ids:
+                continue
+            try:
+                collection = self.get_collection()
+                if collection is not None:
+                    with mongo_write('job_heartbeat'):
+                        collection.update_many({'_id': {'$in': job_ids}, 'status': {'$nin': list(FINAL_STATUSES)}},
+                                               {'$set': {'updated_at': now}})
+            except Exception as e:
+                logger.warning(f"Could not refresh job leases: {e}")
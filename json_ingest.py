@@ -0,0 +1,130 @@
+"""
+Structured sales ingestion for /api/sales
+POS middleware sends explicit date/item/quantity fields, so nothing needs to
+be detected: NDJSON is read a fixed number of lines at a time and every batch
+is folded into per-day totals straight away, so memory stays flat however
+many rows are streamed. Columnar JSON ({"date": [...], "item": [...],
+"quantity": [...]}) is folded in the same fixed-size slices.
+
+Both return the same daily (date, item, quantity) frame as CSV ingest.
+"""
+import io
+import json
+from itertools import islice
+
+import pandas as pd
+
+from config import Config
+from csv_ingest import SALES_COLUMNS, _no_progress, aggregate_sales, infer_date_format, prepare_sales
+from log import RowIssues, get_logger
+
+logger = get_logger('ingest')
+
+# Fields read from each record; quantity is optional (1 per record)
+SALES_FIELDS = ['date', 'item', 'quantity']
+
+# Content types accepted as NDJSON (one JSON object per line)
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl', 'application/json-lines')
+
+def _fold(totals, records, issues, date_format=None):
+    """Add a batch of records (DataFrame with SALES_FIELDS) to the daily totals"""
+    missing_item = records['item'].isna()
+    issues.add('skipped: no item', missing_item.sum())
+    records = records[~missing_item]
+    
+    # Dates are expected as strings (ISO 8601); numbers would be read as epoch nanoseconds
+    records = records.assign(date=records['date'].where(records['date'].isna(), records['date'].astype(str)))
+    qty_col = 'quantity' if records['quantity'].notna().any() else None
+    daily = aggregate_sales(prepare_sales(records, 'date', 'item', qty_col, issues, date_format))
+    return daily if totals is None else totals.add(daily, fill_value=0)
+
+def _parse_lines(lines, issues):
+    """
+    Parse a batch of NDJSON lines into a SALES_FIELDS frame
+    The whole batch goes through pandas' JSON reader; a batch with a bad
+    line is re-read line by line so only the bad lines are skipped
+    """
+    try:
+        records = pd.read_json(io.BytesIO(b''.join(lines)), lines=True, dtype=False, convert_dates=False)
+        return records.reindex(columns=SALES_FIELDS)
+    except (ValueError, TypeError):
+        pass
+    
+    rows = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            issues.add('skipped: not valid JSON', 1, [line[:40].decode('utf-8', 'replace').strip()])
+            continue
+        if not isinstance(record, dict):
+            issues.add('skipped: not a JSON object', 1, [record])
+            continue
+        rows.append(record)
+    return pd.DataFrame.from_records(rows, columns=SALES_FIELDS)
+
+def stream_ndjson_sales(stream, batch_rows=None, progress=None, source='request'):
+    """
+    Aggregate an NDJSON stream into daily sales, one batch of lines at a time
+    
+    Args:
+        stream: Binary file-like object (e.g. request.stream)
+        batch_rows: Lines per batch (defaults to Config.CSV_CHUNK_SIZE)
+        progress: Optional callback(stage, **counters)
+        source: Name used in the row-issues log line
+    
+    Returns:
+        (DataFrame with date, item, quantity columns, rows received, RowIssues)
+    """
+    batch_rows = batch_rows or Config.CSV_CHUNK_SIZE
+    progress = progress or _no_progress
+    totals = None
+    rows_received = 0
+    date_format = None  # inferred from the first batch with dates
+    issues = RowIssues()
+    
+    while True:
+        lines = list(islice(stream, batch_rows))
+        if not lines:
+            break
+        records = _parse_lines(lines, issues)
+        rows_received += sum(1 for line in lines if line.strip())
+        date_format = date_format or infer_date_format(records['date'])
+        totals = _fold(totals, records, issues, date_format)
+        progress('parsing', rows_parsed=rows_received)
+    issues.log(logger, source)
+    
+    daily = pd.DataFrame(columns=SALES_COLUMNS) if totals is None else totals.reset_index()
+    return daily, rows_received, issues
+
+def columnar_sales(payload, batch_rows=None, source='request'):
+    """
+    Aggregate columnar JSON ({"date": [...], "item": [...], "quantity": [...]})
+    into daily sales
+    
+    Returns:
+        (DataFrame with date, item, quantity columns, rows received, RowIssues)
+    Raises ValueError if the arrays are missing or of different lengths
+    """
+    columns = {field: payload.get(field) for field in SALES_FIELDS if payload.get(field) is not None}
+    if not isinstance(columns.get('date'), list) or not isinstance(columns.get('item'), list):
+        raise ValueError("Columnar JSON needs 'date' and 'item' arrays")
+    if any(not isinstance(values, list) for values in columns.values()):
+        raise ValueError("'quantity' must be an array")
+    if len({len(values) for values in columns.values()}) > 1:
+        raise ValueError("'date', 'item' and 'quantity' arrays must have the same length")
+    
+    batch_rows = batch_rows or Config.CSV_CHUNK_SIZE
+    rows_received = len(columns['date'])
+    totals = None
+    date_format = infer_date_format(columns['date'][:1000])
+    issues = RowIssues()
+    for start in range(0, rows_received, batch_rows):
+        records = pd.DataFrame({field: values[start:start + batch_rows] for field, values in columns.items()})
+        totals = _fold(totals, records.reindex(columns=SALES_FIELDS), issues, date_format)
+    issues.log(logger, source)
+    
+    daily = pd.DataFrame(columns=SALES_COLUMNS) if totals is None else totals.reset_index()
+    return daily, rows_received, issues
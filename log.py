@@ -0,0 +1,149 @@
+"""
+Logging setup
+All StockWise loggers hang off the 'stockwise' logger, whose only handler is
+a QueueHandler: callers just enqueue the record and a background listener
+thread formats and writes it, so hot paths never block on stdout
+
+Every record carries the correlation id of the request, upload job or alert
+it belongs to, so all lines of one upload can be found together.
+"""
+import atexit
+import json
+import logging
+import queue
+import threading
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+from config import Config
+
+_correlation_id = ContextVar('stockwise_correlation_id', default='-')
+_listener = None
+_setup_lock = threading.Lock()
+
+class CorrelationFilter(logging.Filter):
+    """Stamp records with the current correlation id"""
+    
+    def filter(self, record):
+        record.correlation_id = _correlation_id.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log aggregators"""
+    
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'correlation_id': getattr(record, 'correlation_id', '-'),
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def setup_logging(level=None, fmt=None):
+    """
+    Route the 'stockwise' loggers through a non-blocking queue (idempotent)
+    
+    Args:
+        level: Log level name (defaults to Config.LOG_LEVEL)
+        fmt: 'text' or 'json' (defaults to Config.LOG_FORMAT)
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        
+        handler = logging.StreamHandler()
+        if (fmt or Config.LOG_FORMAT) == 'json':
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)-7s [%(correlation_id)s] %(name)s: %(message)s'))
+        
+        log_queue = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.addFilter(CorrelationFilter())  # stamped in the caller's context
+        
+        logger = logging.getLogger('stockwise')
+        logger.setLevel((level or Config.LOG_LEVEL).upper())
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+        
+        _listener = QueueListener(log_queue, handler)
+        _listener.start()
+        atexit.register(_listener.stop)  # flush what is still queued
+
+def get_logger(name):
+    """Logger for a StockWise component, e.g. get_logger('ingest')"""
+    return logging.getLogger(f'stockwise.{name}')
+
+def new_correlation_id():
+    """Short random correlation id"""
+    return uuid.uuid4().hex[:12]
+
+def get_correlation_id():
+    """Correlation id of the current context, or None"""
+    value = _correlation_id.get()
+    return None if value == '-' else value
+
+def set_correlation_id(correlation_id):
+    """Set the correlation id until reset_correlation_id(token)"""
+    return _correlation_id.set(correlation_id or '-')
+
+def reset_correlation_id(token):
+    """Restore the correlation id replaced by set_correlation_id()"""
+    _correlation_id.reset(token)
+
+@contextmanager
+def correlation(correlation_id):
+    """Tag every record logged inside the block with correlation_id"""
+    token = set_correlation_id(correlation_id)
+    try:
+        yield
+    finally:
+        reset_correlation_id(token)
+
+def call_with_correlation(correlation_id, func, *args, **kwargs):
+    """Run func under a correlation id (picklable, for worker processes)"""
+    setup_logging()
+    with correlation(correlation_id):
+        return func(*args, **kwargs)
+
+class RowIssues:
+    """
+    Counts of rows skipped or repaired while parsing, with a few sample values
+    each, so a malformed file logs one summary line per problem instead of one
+    line per row
+    
+    Args:
+        max_samples: Sample values kept per problem
+    """
+    
+    def __init__(self, max_samples=3):
+        self.max_samples = max_samples
+        self.counts = {}
+        self.samples = {}
+    
+    def add(self, reason, count, samples=()):
+        """Record `count` rows with a problem, keeping the first few sample values"""
+        if not count:
+            return
+        self.counts[reason] = self.counts.get(reason, 0) + int(count)
+        kept = self.samples.setdefault(reason, [])
+        for sample in samples:
+            if len(kept) >= self.max_samples:
+                break
+            if sample not in kept:
+                kept.append(sample)
+    
+    def log(self, logger, source=''):
+        """Log one warning per problem, e.g. "3,412 rows skipped: bad quantity (e.g. 'x')\""""
+        where = f' in {source}' if source else ''
+        for reason, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+            samples = ', '.join(repr(sample) for sample in self.samples.get(reason, []))
+            logger.warning(f"{count:,} rows{where} {reason}" + (f" (e.g. {samples})" if samples else ''))
@@ -0,0 +1,150 @@
+"""
+Prometheus metrics for the upload hot path
+Stage timings, parse throughput, mapping cache hit rate, MongoDB write and
+email send latency, plus per-request latency, exposed on /metrics
+
+Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+(set up by gunicorn.conf.py) and /metrics merges all workers; a single
+process (flask run, tests) uses the default in-process registry.
+
+Stage timings recorded while collect_timings() is active are also returned
+to the caller, for the Server-Timing response header.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest)
+
+# Pipeline stages take milliseconds (re-forecasts) to minutes (huge exports)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    'stockwise_stage_seconds', 'Time spent in each upload pipeline stage',
+    ['stage'], buckets=STAGE_BUCKETS
+)
+PARSE_ROWS = Counter('stockwise_parse_rows', 'CSV rows parsed (parsed-cache hits excluded)')
+PARSE_ROWS_PER_SECOND = Histogram(
+    'stockwise_parse_rows_per_second', 'CSV parse throughput per upload',
+    buckets=(1e3, 5e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6)
+)
+MAPPING_LOOKUPS = Counter(
+    'stockwise_mapping_lookups', 'Compiled ingredient mapping lookups by cache result (hit, miss, stale)',
+    ['result']
+)
+MONGO_WRITE_SECONDS = Histogram(
+    'stockwise_mongo_write_seconds', 'MongoDB write latency',
+    ['operation'], buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+EMAIL_SEND_SECONDS = Histogram(
+    'stockwise_email_send_seconds', 'Email send latency per transport and outcome (sent, error)',
+    ['transport', 'outcome'], buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'stockwise_http_request_seconds', 'HTTP request latency',
+    ['endpoint', 'method', 'status'], buckets=STAGE_BUCKETS
+)
+
+# Stage durations of the current request or job: {name: seconds}
+_timings = ContextVar('stockwise_timings', default=None)
+
+@contextmanager
+def collect_timings():
+    """
+    Collect the durations recorded in this context (nested calls share the
+    outer collection)
+    
+    Yields:
+        Dict of {name: seconds}, filled in as stages finish
+    """
+    timings = _timings.get()
+    if timings is not None:
+        yield timings
+        return
+    
+    timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+def start_collecting():
+    """Begin collecting timings until stop_collecting(token) (for request hooks)"""
+    return _timings.set({})
+
+def stop_collecting(token):
+    """End a collection started with start_collecting()"""
+    _timings.reset(token)
+
+def current_timings():
+    """Timings collected so far in this context, or None"""
+    return _timings.get()
+
+def record_timing(name, seconds):
+    """Add a duration to the active collection (repeated names add up)"""
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0) + seconds
+
+@contextmanager
+def stage(name):
+    """Time a pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage=name).observe(elapsed)
+        record_timing(name, elapsed)
+
+@contextmanager
+def mongo_write(operation):
+    """Time a MongoDB write"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        MONGO_WRITE_SECONDS.labels(operation=operation).observe(elapsed)
+        record_timing(f'mongo_{operation}', elapsed)
+
+@contextmanager
+def email_send(transport):
+    """Time an email send; failures are recorded with outcome=error"""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'sent'
+    finally:
+        EMAIL_SEND_SECONDS.labels(transport=transport, outcome=outcome).observe(time.perf_counter() - start)
+
+def observe_parse(rows, seconds):
+    """Record rows parsed by one upload and its throughput"""
+    if rows <= 0:
+        return
+    PARSE_ROWS.inc(rows)
+    if seconds > 0:
+        PARSE_ROWS_PER_SECOND.observe(rows / seconds)
+
+def server_timing_header(timings):
+    """Format {name: seconds} as a Server-Timing header value (milliseconds)"""
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items())
+
+def render_metrics():
+    """
+    Current metrics in the Prometheus text format, merged across gunicorn workers
+    
+    Returns:
+        (body bytes, content type)
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,209 @@
+"""
+Per-account daily usage store
+Keeps one usage total per (email, date, ingredient) so each upload merges into
+the account's history instead of reprocessing everything from scratch
+Uses MongoDB when available, otherwise an in-process fallback
+
+MongoDB layout (usage_buckets) - one document per email/ingredient/month:
+    {email, ingredient, month: <first day of month>, usage: [oz per day], updated_at}
+"""
+import calendar
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from pymongo import UpdateMany, UpdateOne
+
+from metrics import mongo_write
+
+USAGE_COLUMNS = ['date', 'ingredient', 'usage_oz']
+
+# In-memory fallback when MongoDB isn't configured
+# {email: {ingredient: {date: usage_oz}}} and {email: {ingredient: [first_date, last_date]}}
+_memory_usage = {}
+_memory_bounds = {}
+_memory_lock = threading.Lock()
+
+def merge_daily_usage(db, email, usage_df):
+    """
+    Merge an upload's daily usage into the account history
+    Days covered by the upload replace whatever was stored for those days,
+    so re-uploading overlapping exports never double counts
+    
+    Args:
+        db: MongoDB database, or None to use the in-memory store
+        email: Account email
+        usage_df: DataFrame with date, ingredient, usage_oz columns
+    """
+    if usage_df.empty:
+        return
+    
+    usage_df = usage_df.assign(date=pd.to_datetime(usage_df['date']).dt.normalize())
+    days = usage_df['date'].drop_duplicates().tolist()
+    bounds = usage_df.groupby('ingredient')['date'].agg(['min', 'max'])
+    
+    if db is None:
+        with _memory_lock:
+            history = _memory_usage.setdefault(email, {})
+            for dates in history.values():
+                for day in days:
+                    dates.pop(day, None)
+            for row in usage_df.itertuples(index=False):
+                history.setdefault(row.ingredient, {})[row.date] = float(row.usage_oz)
+            
+            account_bounds = _memory_bounds.setdefault(email, {})
+            for ingredient, (first, last) in bounds.iterrows():
+                current = account_bounds.get(ingredient)
+                if current is None:
+                    account_bounds[ingredient] = [first, last]
+                else:
+                    account_bounds[ingredient] = [min(current[0], first), max(current[1], last)]
+        return
+    
+    # Replace the covered days in one ordered bulk write:
+    # 1. zero the covered days in every bucket of the account for those months
+    # 2. make sure a bucket exists for each (ingredient, month) in the upload
+    # 3. write the upload's daily values into their slots
+    now = datetime.utcnow()
+    usage_df = usage_df.assign(month=usage_df['date'].dt.to_period('M').dt.to_timestamp(),
+                               slot=usage_df['date'].dt.day - 1)
+    covered = pd.Series(days)
+    requests = []
+    for month, month_days in covered.groupby(covered.dt.to_period('M').dt.to_timestamp()):
+        requests.append(UpdateMany(
+            {'email': email, 'month': month.to_pydatetime()},
+            {'$set': {f'usage.{day.day - 1}': 0.0 for day in month_days}}
+        ))
+    for (ingredient, month), bucket in usage_df.groupby(['ingredient', 'month']):
+        key = {'email': email, 'ingredient': ingredient, 'month': month.to_pydatetime()}
+        requests.append(UpdateOne(
+            key,
+            {'$setOnInsert': {'usage': [0.0] * calendar.monthrange(month.year, month.month)[1]}},
+            upsert=True
+        ))
+        values = {f'usage.{slot}': float(value) for slot, value in zip(bucket['slot'], bucket['usage_oz'])}
+        values['updated_at'] = now
+        requests.append(UpdateOne(key, {'$set': values}))
+    with mongo_write('usage_buckets'):
+        db['usage_buckets'].bulk_write(requests, ordered=True)
+    
+    # First/last usage day per ingredient, so forecasts never scan full history
+    with mongo_write('usage_bounds'):
+        db['usage_bounds'].bulk_write([
+            UpdateOne(
+                {'email': email, 'ingredient': ingredient},
+                {'$min': {'first_date': first.to_pydatetime()},
+                 '$max': {'last_date': last.to_pydatetime()}},
+                upsert=True
+            )
+            for ingredient, (first, last) in bounds.iterrows()
+        ], ordered=False)
+
+def load_trailing_usage(db, email, ingredients, window=7):
+    """
+    Load just enough history to forecast the given ingredients: the trailing
+    window ending at each ingredient's last usage day
+    
+    If an ingredient's history starts before its window, a zero-usage row is
+    added at the window start so the rolling average divides by the full
+    window - the result matches forecasting over the complete history
+    
+    Returns:
+        DataFrame with date, ingredient, usage_oz columns
+    """
+    ingredients = list(ingredients)
+    if not ingredients:
+        return pd.DataFrame(columns=USAGE_COLUMNS)
+    
+    if db is None:
+        rows = []
+        with _memory_lock:
+            history = _memory_usage.get(email, {})
+            account_bounds = _memory_bounds.get(email, {})
+            for ingredient in ingredients:
+                if ingredient not in account_bounds:
+                    continue
+                first, last = account_bounds[ingredient]
+                dates = history.get(ingredient, {})
+                window_start = last - timedelta(days=window - 1)
+                if first < window_start:
+                    rows.append((window_start, ingredient, 0.0))
+                for offset in range(window):
+                    day = window_start + timedelta(days=offset)
+                    if day in dates:
+                        rows.append((day, ingredient, dates[day]))
+        return pd.DataFrame(rows, columns=USAGE_COLUMNS)
+    
+    bounds = pd.DataFrame(list(db['usage_bounds'].find(
+        {'email': email, 'ingredient': {'$in': ingredients}},
+        {'_id': 0, 'ingredient': 1, 'first_date': 1, 'last_date': 1}
+    )))
+    if bounds.empty:
+        return pd.DataFrame(columns=USAGE_COLUMNS)
+    bounds['window_start'] = bounds['last_date'] - pd.Timedelta(days=window - 1)
+    
+    usage = read_buckets(db, email, bounds['ingredient'].tolist(),
+                         bounds['window_start'].min(), bounds['last_date'].max())
+    
+    # Trim the shared date range down to each ingredient's own window
+    usage = usage.merge(bounds[['ingredient', 'window_start', 'last_date']], on='ingredient')
+    usage = usage[(usage['date'] >= usage['window_start']) & (usage['date'] <= usage['last_date'])]
+    
+    padding = bounds.loc[bounds['first_date'] < bounds['window_start'], ['window_start', 'ingredient']]
+    padding = padding.rename(columns={'window_start': 'date'}).assign(usage_oz=0.0)
+    
+    return pd.concat([padding, usage[USAGE_COLUMNS]], ignore_index=True)
+
+def read_buckets(db, email, ingredients, start, end):
+    """
+    Read daily usage between start and end (inclusive) from the monthly buckets
+    Only the buckets overlapping the range are fetched
+    
+    Returns:
+        DataFrame with date, ingredient, usage_oz columns (days with usage only)
+    """
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+    query = {
+        'email': email,
+        'month': {'$gte': start.replace(day=1).to_pydatetime(), '$lte': end.to_pydatetime()}
+    }
+    if ingredients is not None:
+        query['ingredient'] = {'$in': list(ingredients)}
+    
+    frames = []
+    for bucket in db['usage_buckets'].find(query, {'_id': 0, 'ingredient': 1, 'month': 1, 'usage': 1}):
+        usage = np.asarray(bucket['usage'], dtype=float)
+        slots = np.flatnonzero(usage)
+        if len(slots):
+            frames.append(pd.DataFrame({
+                'date': pd.Timestamp(bucket['month']) + pd.to_timedelta(slots, unit='D'),
+                'ingredient': bucket['ingredient'],
+                'usage_oz': usage[slots]
+            }))
+    if not frames:
+        return pd.DataFrame(columns=USAGE_COLUMNS)
+    
+    usage = pd.concat(frames, ignore_index=True)
+    return usage[(usage['date'] >= start) & (usage['date'] <= end)].reset_index(drop=True)
+
+def load_usage_history(db, email, start, end, ingredients=None):
+    """
+    Daily usage for an account between start and end (inclusive)
+    
+    Returns:
+        DataFrame with date, ingredient, usage_oz columns sorted by date
+    """
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+    
+    if db is None:
+        rows = []
+        with _memory_lock:
+            for ingredient, dates in _memory_usage.get(email, {}).items():
+                if ingredients is not None and ingredient not in ingredients:
+                    continue
+                rows.extend((day, ingredient, usage) for day, usage in dates.items() if start <= day <= end)
+        usage = pd.DataFrame(rows, columns=USAGE_COLUMNS)
+    else:
+        usage = read_buckets(db, email, ingredients, start, end)
+    
+    return usage.sort_values(['date', 'ingredient']).reset_index(drop=True)